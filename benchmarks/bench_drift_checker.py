@@ -0,0 +1,244 @@
+"""Offline benchmark of db_drift_checker.py on a synthetic fleet.
+
+The fleet (db config, dblists, schema file and the information_schema dump
+of every wiki on every host) is generated in a scratch directory, the http
+cache is seeded with it and the checker runs with --offline against
+fake_sql.py, so the whole prod code path is exercised without a network or
+a database. Results are appended to a jsonl file along with the current
+commit, so runs of different commits can be compared.
+
+Example:
+    python3 benchmarks/bench_drift_checker.py --sections 4 --hosts 5 --wikis 50 \\
+        --checker-args "--jobs 8 --bulk"
+"""
+import argparse
+import base64
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_dbapi  # noqa: E402
+import synthetic  # noqa: E402
+from checker import DriftStore  # noqa: E402
+from data_access.cache import HttpCache  # noqa: E402
+from data_access.sql import DbApiBackend, iter_vertical_rows  # noqa: E402
+from data_access.wmf import Gerrit, get_dblist_path  # noqa: E402
+
+# Runs the checker and writes its peak RSS (in kB) to the file in argv[1]
+RUNNER = '''
+import atexit, os, resource, runpy, sys
+rss_path, script = sys.argv[1], sys.argv[2]
+def write_rss():
+    with open(rss_path, 'w') as f:
+        f.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+atexit.register(write_rss)
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(script))
+runpy.run_path(script, run_name='__main__')
+'''
+
+
+def setup_fleet(workdir, args):
+    """Generates the fleet in workdir and seeds the http cache with it"""
+    schema = synthetic.generate_schema(args.tables, args.seed)
+    dbconfig, dblists = synthetic.generate_fleet(
+        args.sections, args.hosts, args.wikis, args.seed)
+    dumps = os.path.join(workdir, 'dumps')
+    synthetic.write_dumps(dumps, schema, dbconfig, dblists, args.drift_rate, args.seed)
+
+    cache = HttpCache(os.path.join(workdir, 'cache'))
+    gerrit = Gerrit()
+    cache.put(
+        'https://noc.wikimedia.org/dbconfig/eqiad.json',
+        json.dumps(dbconfig).encode('utf-8'))
+    for section, wikis in dblists.items():
+        cache.put(
+            gerrit.get_url(get_dblist_path(section)),
+            base64.b64encode('\n'.join(wikis).encode('utf-8')))
+    with open(os.path.join(ROOT, 'abstract_paths.json'), 'r') as f:
+        schema_config = json.loads(f.read())
+    for path in schema_config['core']['path']:
+        cache.put(
+            gerrit.get_url(path),
+            base64.b64encode(json.dumps(schema).encode('utf-8')))
+    shutil.copy(os.path.join(ROOT, 'abstract_paths.json'), workdir)
+    return dumps
+
+
+def run_checker(workdir, dumps, checker_args):
+    command = '{} {} {} {{wiki}} -- '.format(
+        shlex.quote(sys.executable),
+        shlex.quote(os.path.join(ROOT, 'benchmarks', 'fake_sql.py')),
+        shlex.quote(dumps))
+    rss_path = os.path.join(workdir, 'rss')
+    argv = [
+        sys.executable, '-c', RUNNER, rss_path,
+        os.path.join(ROOT, 'db_drift_checker.py'), 'core', command,
+        '--prod', '--all', '--offline', '--cache-dir', os.path.join(workdir, 'cache'),
+        '--flush-interval', '0',
+    ] + shlex.split(checker_args)
+    start = time.perf_counter()
+    subprocess.run(argv, cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    with open(rss_path, 'r') as f:
+        peak_rss = int(f.read())
+    with open(os.path.join(workdir, 'drifts_core.json'), 'r') as f:
+        drifts = json.loads(f.read())
+    return wall, peak_rss, drifts
+
+
+def bench_parse(dumps):
+    """Rows per second parsed out of the vertical dumps"""
+    rows = 0
+    elapsed = 0.0
+    for host in os.listdir(dumps):
+        for name in os.listdir(os.path.join(dumps, host)):
+            if not name.endswith('.txt'):
+                continue
+            with open(os.path.join(dumps, host, name), 'r') as f:
+                lines = f.readlines()
+            start = time.perf_counter()
+            rows += sum(1 for _ in iter_vertical_rows(lines))
+            elapsed += time.perf_counter() - start
+    return rows / elapsed if elapsed else 0
+
+
+def bench_dbapi(workdir, dumps):
+    """Rows per second going through the DB-API backend, against the SQLite
+    stand-in of the hosts. Mostly measures the normalization of the rows."""
+    backend = DbApiBackend('eqiad', fake_dbapi.Connector(
+        fake_dbapi.build(dumps, os.path.join(workdir, 'sqlite'))))
+    rows = 0
+    elapsed = 0.0
+    for host in os.listdir(dumps):
+        wikis = [
+            name[:-len('.json')] for name in os.listdir(os.path.join(dumps, host))
+            if name.endswith('.json')]
+        start = time.perf_counter()
+        rows += len(backend.get_tables_structure(host, '', wikis))
+        elapsed += time.perf_counter() - start
+    backend.close()
+    return rows / elapsed if elapsed else 0
+
+
+def bench_write(workdir, drifts, repeat=5):
+    """Seconds it takes to write the drifts file of the run once"""
+    store = DriftStore('core', 0, os.path.join(workdir, 'drifts_bench.json'))
+    store.merge(drifts)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        store.flush()
+    return (time.perf_counter() - start) / repeat, os.path.getsize(store.path)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(path, result):
+    """Last saved result of the same benchmark, if any"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record['fleet'] == result['fleet'] and \
+                    record['checker_args'] == result['checker_args']:
+                previous = record
+    return previous
+
+
+def print_result(result, previous):
+    print('Fleet:', json.dumps(result['fleet'], sort_keys=True))
+    print('Checker args:', result['checker_args'] or '(none)')
+    if previous:
+        print('Compared to {} ({})'.format(
+            previous['commit'], time.ctime(previous['time'])))
+    for metric, value in sorted(result['metrics'].items()):
+        line = '{:>24}: {:.4g}'.format(metric, value)
+        if previous and previous['metrics'].get(metric):
+            change = (value - previous['metrics'][metric]) / previous['metrics'][metric]
+            line += '  ({:+.1%})'.format(change)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the drift checker on a synthetic fleet')
+    parser.add_argument('--sections', type=int, default=2)
+    parser.add_argument('--hosts', type=int, default=3, help='Hosts per section')
+    parser.add_argument('--wikis', type=int, default=10, help='Wikis per section')
+    parser.add_argument('--tables', type=int, default=40)
+    parser.add_argument(
+        '--drift-rate', type=float, default=0.01,
+        help='Chance of every column to be drifted')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--checker-args', default='',
+        help='Extra arguments for db_drift_checker.py, like "--jobs 8 --bulk"')
+    parser.add_argument(
+        '--results', default=os.path.join(ROOT, 'benchmarks', 'results.jsonl'),
+        help='Where results are appended to and compared against')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--keep', help='Generate the fleet in this directory and keep it')
+    args = parser.parse_args()
+
+    workdir = args.keep or tempfile.mkdtemp(prefix='drift_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        dumps = setup_fleet(workdir, args)
+        wall, peak_rss, drifts = run_checker(workdir, dumps, args.checker_args)
+        write_seconds, drifts_size = bench_write(workdir, drifts)
+        hosts = args.sections * args.hosts
+        result = {
+            'time': time.time(),
+            'commit': git_commit(),
+            'fleet': {
+                'sections': args.sections,
+                'hosts': args.hosts,
+                'wikis': args.wikis,
+                'tables': args.tables,
+                'drift_rate': args.drift_rate,
+                'seed': args.seed,
+            },
+            'checker_args': args.checker_args,
+            'metrics': {
+                'wall_seconds': wall,
+                'hosts_per_second': hosts / wall,
+                'wikis_per_second': hosts * args.wikis / wall,
+                'peak_rss_kb': peak_rss,
+                'drifts': len(drifts) - 1,
+                'drifts_file_write_seconds': write_seconds,
+                'drifts_file_bytes': drifts_size,
+                'parse_rows_per_second': bench_parse(dumps),
+                'dbapi_rows_per_second': bench_dbapi(workdir, dumps),
+            },
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_result(result, previous_result(args.results, result))
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
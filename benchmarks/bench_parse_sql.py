@@ -0,0 +1,210 @@
+"""Benchmark of db_abstractor.parse_sql against the regex based parser it
+replaced, on generated SQL in the style of MediaWiki's tables.sql and of
+mysqldump --no-data. Both have to produce the same abstract schema on the
+MediaWiki style input.
+
+    python3 benchmarks/bench_parse_sql.py --tables 100 1000 5000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_abstractor import abstract_schema, parse_sql  # noqa: E402
+
+COLUMN_TYPES = [
+    'int unsigned NOT NULL',
+    'int NOT NULL default 0',
+    'bigint unsigned NOT NULL',
+    "varbinary(255) NOT NULL default ''",
+    'varchar(255) binary NOT NULL',
+    'binary(14) NOT NULL',
+    'blob NOT NULL',
+    'mediumblob',
+    'tinyint unsigned NOT NULL default 0',
+    'varbinary(32) DEFAULT NULL',
+    "ENUM('one', 'two', 'three') NOT NULL default 'one'",
+]
+
+
+def parse_sql_regex(sql):
+    """The parser db_abstractor used to have, kept as the reference"""
+    result = {}
+    sql = sql.replace('IF NOT EXISTS ', '')
+    sql = re.sub(r'\s*\-\-.*', '', sql)
+
+    for table_chunk in sql.split('CREATE TABLE '):
+        table_chunk = table_chunk.lower()
+        table_chunk = re.sub(r'/\*.+?\*/', '', table_chunk)
+        table_chunk = re.sub(r'\n\s*\n', '\n', table_chunk)
+
+        table_name = table_chunk.split('(')[0].strip()
+
+        if not table_name or '\n' in table_name:
+            continue
+        if '(' not in table_chunk:
+            continue
+        indexes = {}
+
+        for res in re.findall(r'create( +unique|)(?: +fulltext|) +index +(\S+?)[ \n]+on +%s +\((.+?)\)\;' % table_name, table_chunk):
+            indexes[res[1]] = {'unique': bool(res[0]), 'columns': res[2]}
+
+        table_structure = re.split(
+            r'create( +unique|) +index', '('.join(table_chunk.split('(')[1:]))[0]
+
+        table_structure_real = {}
+
+        pk = None
+        for line in table_structure.split('\n'):
+            line = line.strip()
+            if not line or line.endswith(';'):
+                continue
+
+            if line.endswith(','):
+                line = line[:-1]
+
+            line = re.sub(r' +', ' ', line)
+            lineSplitSpace = line.split(' ')
+
+            opts = {}
+            if 'primary key' in line:
+                if line.startswith('primary key'):
+                    pk = line.split('(')[1].split(')')[0].replace(' ', '')
+                    continue
+                else:
+                    pk = lineSplitSpace[0]
+                    if 'auto_increment' in line:
+                        opts['autoincrement'] = True
+            elif re.search(r'key +\(', line):
+                continue
+
+            if lineSplitSpace[1].startswith('enum'):
+                real_type = ' '.join(line.split(')')[0].split(' ')[1:]) + ')'
+                real_type = real_type.replace('"', '\'').replace(' ', '')
+            else:
+                real_type = lineSplitSpace[1]
+
+            if ' unsigned ' in line:
+                line = line.replace(' unsigned ', ' ')
+                opts['unsigned'] = True
+
+            not_null = 'not null' in line
+            if not_null:
+                line = line.replace('not null', ' ')
+            opts['notnull'] = not_null
+
+            if ' default' in line:
+                default = re.findall(r'default +(.+?)(?:\s|$)', line)[0]
+                if '\'' in default:
+                    default = str(default).replace('\'', '')
+
+                if default.isnumeric():
+                    default = int(default)
+                elif default == 'null':
+                    default = None
+
+                opts['default'] = default
+
+            table_structure_real[lineSplitSpace[0]] = {
+                'type': real_type,
+                'config': ' '.join(lineSplitSpace[2:]),
+                'options': opts,
+            }
+
+        result[table_name] = {
+            'structure': table_structure_real,
+            'indexes': indexes
+        }
+        if pk is not None:
+            result[table_name]['pk'] = pk
+
+    return result
+
+
+def _tables(count, seed):
+    random_ = random.Random(seed)
+    for t in range(count):
+        name = 'table{}'.format(t)
+        columns = [
+            ('{}_col{}'.format(name, c), random_.choice(COLUMN_TYPES))
+            for c in range(random_.randint(3, 15))]
+        indexes = [
+            ('{}_index{}'.format(name, i),
+             random_.random() < 0.3,
+             [column for column, _ in random_.sample(columns, min(len(columns), 2))])
+            for i in range(random_.randint(0, 3))]
+        yield name, columns, indexes
+
+
+def generate_mediawiki_sql(count, seed=0):
+    parts = ['-- Generated schema, in the style of tables.sql\n']
+    for name, columns, indexes in _tables(count, seed):
+        lines = ['  {}_id int unsigned NOT NULL PRIMARY KEY AUTO_INCREMENT,'.format(name)]
+        for column, type_ in columns:
+            lines.append('  -- The {} column'.format(column))
+            lines.append('  {} {},'.format(column, type_))
+        lines[-1] = lines[-1][:-1]
+        parts.append('\n-- The {} table\nCREATE TABLE /*_*/{} (\n{}\n) /*$wgDBTableOptions*/;\n\n'.format(
+            name, name, '\n'.join(lines)))
+        for index, unique, index_columns in indexes:
+            parts.append('CREATE {}INDEX /*i*/{} ON /*_*/{} ({});\n'.format(
+                'UNIQUE ' if unique else '', index, name, ','.join(index_columns)))
+    return ''.join(parts)
+
+
+def generate_mysqldump_sql(count, seed=0):
+    parts = ['/*!40101 SET NAMES binary */;\n']
+    for name, columns, indexes in _tables(count, seed):
+        lines = ['  `{}_id` int(10) unsigned NOT NULL AUTO_INCREMENT,'.format(name)]
+        for column, type_ in columns:
+            lines.append('  `{}` {},'.format(column, type_))
+        lines.append('  PRIMARY KEY (`{}_id`),'.format(name))
+        for index, unique, index_columns in indexes:
+            lines.append('  {}KEY `{}` ({}),'.format(
+                'UNIQUE ' if unique else '', index,
+                ','.join('`{}`'.format(i) for i in index_columns)))
+        lines[-1] = lines[-1][:-1]
+        parts.append(
+            'DROP TABLE IF EXISTS `{0}`;\n/*!40101 SET @saved_cs_client = @@character_set_client */;\n'
+            'CREATE TABLE `{0}` (\n{1}\n) ENGINE=InnoDB DEFAULT CHARSET=binary;\n\n'.format(
+                name, '\n'.join(lines)))
+    return ''.join(parts)
+
+
+def measure(func, sql, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(sql)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the sql parser of db_abstractor')
+    parser.add_argument('--tables', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>10} {:>7} {:>10} {:>10} {:>8}  {}'.format(
+        'style', 'tables', 'regex (s)', 'tokens (s)', 'speedup', 'same schema'))
+    for count in args.tables:
+        for style, generate in (
+                ('mediawiki', generate_mediawiki_sql), ('mysqldump', generate_mysqldump_sql)):
+            sql = generate(count)
+            regex_time, regex_result = measure(parse_sql_regex, sql, args.repeat)
+            tokens_time, tokens_result = measure(parse_sql, sql, args.repeat)
+            # The old parser doesn't understand backticks nor inline keys
+            same = abstract_schema(regex_result) == abstract_schema(tokens_result) \
+                if style == 'mediawiki' else 'n/a'
+            print('{:>10} {:>7} {:>10.3f} {:>10.3f} {:>7.1f}x  {}'.format(
+                style, count, regex_time, tokens_time, regex_time / tokens_time, same))
+
+
+if __name__ == '__main__':
+    main()
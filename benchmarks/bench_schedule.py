@@ -0,0 +1,74 @@
+"""Compares the ways db_drift_checker.py can schedule its queries, on the
+same synthetic fleet and with the same simulated network and server
+latency (see fake_sql.py):
+
+- wiki: one job per wiki and host, every host of a wiki one after the other
+- host: one job per host going through all of its wikis, hosts spread over
+  sections so that the parallel jobs don't wait on the same few hosts
+- host + pipeline: the same, with all the queries of a host in one session
+- bulk: one query per host for all of its wikis
+
+Example:
+    python3 benchmarks/bench_schedule.py --sections 4 --hosts 3 --wikis 20 --jobs 6
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_drift_checker import run_checker, setup_fleet  # noqa: E402
+
+SCHEDULES = [
+    ('wiki', ''),
+    ('host', '--schedule host'),
+    ('host + pipeline', '--schedule host --pipeline'),
+    ('bulk', '--bulk'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scheduling modes of the drift checker')
+    parser.add_argument('--sections', type=int, default=4)
+    parser.add_argument('--hosts', type=int, default=3, help='Hosts per section')
+    parser.add_argument('--wikis', type=int, default=10, help='Wikis per section')
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--drift-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=6)
+    parser.add_argument(
+        '--connect-latency', type=float, default=0.1,
+        help='Seconds it takes to open a session to a host')
+    parser.add_argument(
+        '--query-latency', type=float, default=0.05,
+        help='Seconds the server spends on the tables of one wiki')
+    args = parser.parse_args()
+
+    os.environ['FAKE_SQL_CONNECT_LATENCY'] = str(args.connect_latency)
+    os.environ['FAKE_SQL_QUERY_LATENCY'] = str(args.query_latency)
+    workdir = tempfile.mkdtemp(prefix='schedule_bench_')
+    try:
+        dumps = setup_fleet(workdir, args)
+        print('{:>16} {:>10} {:>8}  {}'.format('schedule', 'wall (s)', 'speedup', 'same drifts'))
+        reference = None
+        for name, checker_args in SCHEDULES:
+            wall, _, drifts = run_checker(
+                workdir, dumps, '--jobs {} {}'.format(args.jobs, checker_args))
+            drifts.pop('_metadata')
+            drifts = json.dumps(
+                {drift: {section: sorted(entries) for section, entries in sections.items()}
+                 for drift, sections in drifts.items()}, sort_keys=True)
+            if reference is None:
+                reference = (wall, drifts)
+            print('{:>16} {:>10.2f} {:>7.1f}x  {}'.format(
+                name, wall, reference[0] / wall, drifts == reference[1]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
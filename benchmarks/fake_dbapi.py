@@ -0,0 +1,119 @@
+"""SQLite backed stand-in for the hosts of DbApiBackend, reading the dumps
+written by synthetic.write_dumps instead of connecting to MariaDB.
+
+Every host gets a SQLite database with the information_schema tables the
+backend queries (columns, statistics and tables), attached under the name
+information_schema so the queries run unchanged:
+
+    directory = fake_dbapi.build(dumps, workdir)
+    backend = DbApiBackend('eqiad', fake_dbapi.Connector(directory))
+
+Connections keep the read timeout the way PyMySQL ones do, and log the one
+in effect for every query in `timeouts`. Unknown hosts can't be connected
+to.
+"""
+import json
+import os
+import sqlite3
+
+COLUMNS = (
+    'TABLE_CATALOG', 'TABLE_SCHEMA', 'TABLE_NAME', 'COLUMN_NAME', 'COLUMN_TYPE',
+    'IS_NULLABLE', 'EXTRA', 'COLUMN_COMMENT')
+STATISTICS = (
+    'TABLE_CATALOG', 'TABLE_SCHEMA', 'TABLE_NAME', 'NON_UNIQUE', 'INDEX_SCHEMA',
+    'INDEX_NAME', 'SEQ_IN_INDEX', 'COLUMN_NAME')
+TABLES = ('TABLE_SCHEMA', 'TABLE_NAME', 'CREATE_TIME')
+CREATE_TIME = '2024-01-01 00:00:00'
+
+
+def _create(db, name, columns):
+    db.execute('CREATE TABLE {} ({})'.format(
+        name, ', '.join('{} TEXT'.format(i) for i in columns)))
+
+
+def _insert(db, name, columns, rows):
+    db.executemany(
+        'INSERT INTO {} VALUES ({})'.format(name, ', '.join(['?'] * len(columns))),
+        [[row.get(i) for i in columns] for row in rows])
+
+
+def build(dumps, directory):
+    """Writes <directory>/<host>.sqlite out of the JSON dumps of every host
+    and returns the directory"""
+    os.makedirs(directory, exist_ok=True)
+    for host in os.listdir(dumps):
+        path = os.path.join(directory, host + '.sqlite')
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        _create(db, 'columns', COLUMNS)
+        _create(db, 'statistics', STATISTICS)
+        _create(db, 'tables', TABLES)
+        for name in sorted(os.listdir(os.path.join(dumps, host))):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(dumps, host, name), 'r') as f:
+                rows = json.loads(f.read())
+            columns = [row for row in rows if 'COLUMN_TYPE' in row]
+            _insert(db, 'columns', COLUMNS, columns)
+            _insert(db, 'statistics', STATISTICS, [
+                row for row in rows if 'INDEX_NAME' in row])
+            tables = dict.fromkeys(row['TABLE_NAME'] for row in columns)
+            _insert(db, 'tables', TABLES, [{
+                'TABLE_SCHEMA': name[:-len('.json')],
+                'TABLE_NAME': table,
+                'CREATE_TIME': CREATE_TIME,
+            } for table in tables])
+        db.commit()
+        db.close()
+    return directory
+
+
+class Cursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self._cursor = connection._db.cursor()
+
+    def execute(self, query, params):
+        self.connection.timeouts.append(self.connection._read_timeout)
+        # The backend uses the "format" paramstyle, SQLite the "qmark" one
+        self._cursor.execute(query.replace('%s', '?'), params)
+        self.description = self._cursor.description
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection(object):
+    def __init__(self, path, timeout):
+        if not os.path.exists(path):
+            raise Exception('Unknown host: {}'.format(path))
+        self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.execute('ATTACH DATABASE ? AS information_schema', (path,))
+        self._read_timeout = timeout
+        self.timeouts = []
+
+    def cursor(self):
+        return Cursor(self)
+
+    def close(self):
+        self._db.close()
+
+
+class Connector(object):
+    """`connect` callable of DbApiBackend for the hosts built in directory,
+    keeping the connections it opened in `connections`"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.connections = []
+
+    def __call__(self, host, port, timeout):
+        connection = Connection(
+            os.path.join(self.directory, host.split('.')[0] + '.sqlite'), timeout)
+        self.connections.append(connection)
+        return connection
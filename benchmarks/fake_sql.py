@@ -0,0 +1,58 @@
+"""Stand-in for the `sql` wrapper reading the dumps written by
+synthetic.write_dumps instead of querying a real host.
+
+Usage: fake_sql.py DUMPS_DIR WIKI -- -h HOST.DC.wmnet -e QUERY
+
+FAKE_SQL_CONNECT_LATENCY and FAKE_SQL_QUERY_LATENCY (seconds, per session
+and per wiki queried) simulate the time spent on the network and in the
+server, which doesn't use any cpu on the client.
+
+The schema version of a wiki is the number of tables in its dump and the
+time the dump was last modified. With FAKE_SQL_LOG set, every query is
+logged to that file as a JSON line with the host, the wikis and whether
+it only asked for versions.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+
+def main(argv):
+    dumps = argv[0]
+    host = argv[argv.index('-h') + 1].split('.')[0]
+    query = argv[argv.index('-e') + 1]
+    # A wiki shows up once per statement, its dump has the rows of both
+    wikis = list(dict.fromkeys(re.findall(r"'([^']+)'", query)))
+    out = sys.stdout
+    versions = 'information_schema.tables' in query
+    if os.environ.get('FAKE_SQL_LOG'):
+        with open(os.environ['FAKE_SQL_LOG'], 'a') as f:
+            f.write(json.dumps({'host': host, 'wikis': wikis, 'versions': versions}) + '\n')
+    time.sleep(
+        float(os.environ.get('FAKE_SQL_CONNECT_LATENCY', 0)) +
+        float(os.environ.get('FAKE_SQL_QUERY_LATENCY', 0)) * len(wikis))
+    if versions:
+        for number, wiki in enumerate(wikis, 1):
+            path = os.path.join(dumps, host, wiki + '.txt')
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                tables = set(re.findall(r'^ *TABLE_NAME: (.*)$', f.read(), re.M))
+            out.write('*' * 27 + ' {}. row '.format(number) + '*' * 27 + '\n')
+            out.write('TABLE_SCHEMA: {}\n'.format(wiki))
+            out.write('      TABLES: {}\n'.format(len(tables)))
+            out.write(' CREATE_TIME: {}\n'.format(time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.gmtime(os.path.getmtime(path)))))
+        return
+    for wiki in wikis:
+        path = os.path.join(dumps, host, wiki + '.txt')
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            out.write(f.read())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+"""Synthetic fleets for the benchmarks: an abstract schema, a db config in
+the format of noc.wikimedia.org, dblists and the information_schema rows
+every host would return, with drifts injected at a given rate."""
+import json
+import os
+import random
+
+COLUMN_TYPES = [
+    ('integer', {'unsigned': True, 'notnull': True}, 'int(10) unsigned'),
+    ('bigint', {'unsigned': True, 'notnull': True}, 'bigint(20) unsigned'),
+    ('binary', {'length': 32, 'notnull': True, 'fixed': True}, 'binary(32)'),
+    ('string', {'length': 255, 'notnull': True}, 'varbinary(255)'),
+    ('blob', {'length': 65530, 'notnull': False}, 'blob'),
+    ('mwtimestamp', {'notnull': True}, 'binary(14)'),
+    ('mwtinyint', {'length': 1, 'notnull': True}, 'tinyint(1)'),
+    ('mwenum', {'notnull': True, 'CustomSchemaOptions': {'enum_values': ['a', 'b', 'c']}}, "enum('a','b','c')"),
+]
+DRIFTED_TYPES = ['varchar(10)', 'int(11)', 'mediumblob', 'binary(14)']
+
+
+def generate_schema(tables, seed=0):
+    random_ = random.Random(seed)
+    schema = []
+    for t in range(tables):
+        name = 'table{}'.format(t)
+        columns = [{
+            'name': '{}_id'.format(name),
+            'type': 'integer',
+            'options': {'unsigned': True, 'notnull': True, 'autoincrement': True},
+        }]
+        for c in range(random_.randint(3, 12)):
+            type_, options, _ = random_.choice(COLUMN_TYPES)
+            columns.append({
+                'name': '{}_col{}'.format(name, c),
+                'type': type_,
+                'options': dict(options),
+            })
+        indexes = []
+        for i in range(random_.randint(0, 3)):
+            indexes.append({
+                'name': '{}_index{}'.format(name, i),
+                'unique': random_.random() < 0.3,
+                'columns': [
+                    column['name']
+                    for column in random_.sample(columns[1:], min(2, len(columns) - 1))],
+            })
+        schema.append({
+            'name': name,
+            'columns': columns,
+            'indexes': indexes,
+            'pk': [columns[0]['name']],
+        })
+    return schema
+
+
+def _column_type(column):
+    for type_, _, column_type in COLUMN_TYPES:
+        if type_ == column['type']:
+            return column_type
+    return 'int(10) unsigned'
+
+
+def physical_rows(schema, wiki, host, drift_rate, seed=0):
+    """Rows of information_schema.columns and .statistics of the wiki on
+    the host. Drifts depend on the wiki and the host, but most wikis end
+    up with the exact same schema, like in production."""
+    random_ = random.Random('{}:{}:{}'.format(seed, host, wiki))
+    rows = []
+    for table in schema:
+        for column in table['columns']:
+            column_type = _column_type(column)
+            if random_.random() < drift_rate:
+                column_type = random_.choice(DRIFTED_TYPES)
+            name = column['name']
+            if random_.random() < drift_rate / 4:
+                name += '_old'
+            rows.append({
+                'TABLE_CATALOG': 'def',
+                'TABLE_SCHEMA': wiki,
+                'TABLE_NAME': table['name'],
+                'COLUMN_NAME': name,
+                'COLUMN_TYPE': column_type,
+                'IS_NULLABLE': 'NO' if column['options'].get('notnull') else 'YES',
+                'EXTRA': 'auto_increment' if column['options'].get('autoincrement') else '',
+                'COLUMN_COMMENT': '',
+            })
+        indexes = [('PRIMARY', True, table['pk'])]
+        indexes += [(i['name'], i['unique'], i['columns']) for i in table['indexes']]
+        for index_name, unique, columns in indexes:
+            if index_name != 'PRIMARY' and random_.random() < drift_rate / 4:
+                continue
+            if random_.random() < drift_rate / 4:
+                unique = not unique
+            for seq, column in enumerate(columns, 1):
+                rows.append({
+                    'TABLE_CATALOG': 'def',
+                    'TABLE_SCHEMA': wiki,
+                    'TABLE_NAME': table['name'],
+                    'NON_UNIQUE': '0' if unique else '1',
+                    'INDEX_SCHEMA': wiki,
+                    'INDEX_NAME': index_name,
+                    'SEQ_IN_INDEX': str(seq),
+                    'COLUMN_NAME': column,
+                })
+    return rows
+
+
+def to_vertical(rows, start=1):
+    """Formats rows the way `mysql -e "...\\G"` prints them"""
+    lines = []
+    for number, row in enumerate(rows, start):
+        lines.append('{0} {1}. row {0}'.format('*' * 27, number))
+        for key, value in row.items():
+            lines.append('{:>24}: {}'.format(key, value))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_fleet(sections, hosts, wikis, seed=0):
+    """Db config and dblists of a fleet with `sections` sections of `hosts`
+    replicas each, every section holding `wikis` wikis"""
+    dbconfig = {'sectionLoads': {}}
+    dblists = {}
+    host_number = 1000
+    for s in range(1, sections + 1):
+        section = 's{}'.format(s)
+        loads = {}
+        for _ in range(hosts):
+            host_number += 1
+            loads['db{}'.format(host_number)] = 100
+        # Like in production, primary first then replicas
+        dbconfig['sectionLoads'][section] = [
+            dict(list(loads.items())[:1]), dict(list(loads.items())[1:])]
+        dblists[section] = ['s{}wiki{}'.format(s, w) for w in range(wikis)]
+    return dbconfig, dblists
+
+
+def write_dumps(directory, schema, dbconfig, dblists, drift_rate, seed=0):
+    """Writes the vertical text dump and the rows (as JSON) of every wiki
+    on every host, under <directory>/<host>/<wiki>.{txt,json}"""
+    count = 0
+    for section, loads in dbconfig['sectionLoads'].items():
+        for load in loads:
+            for host in load:
+                os.makedirs(os.path.join(directory, host), exist_ok=True)
+                for wiki in dblists[section]:
+                    rows = physical_rows(schema, wiki, host, drift_rate, seed)
+                    path = os.path.join(directory, host, wiki)
+                    with open(path + '.txt', 'w') as f:
+                        f.write(to_vertical(rows))
+                    with open(path + '.json', 'w') as f:
+                        f.write(json.dumps(rows))
+                    count += 1
+    return count
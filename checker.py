@@ -1,16 +1,205 @@
-
+import hashlib
 import json
 import sys
+import threading
+import time
+from collections import defaultdict
 
 from domain.db import Db
+from drift_format import columnar_path, write_columnar
+from instrumentation import timings
+
+
+def _merge_counters(a, b):
+    merged = dict(a)
+    for key, value in b.items():
+        if key not in merged:
+            merged[key] = value
+        elif isinstance(value, dict):
+            merged[key] = _merge_counters(merged[key], value)
+        elif isinstance(value, list):
+            merged[key] = merged[key] + value
+        elif key == 'max':
+            merged[key] = max(merged[key], value)
+        else:
+            merged[key] = merged[key] + value
+    return merged
+
+
+def _count_distinct(stats):
+    """Sets distinct_* of merged stats from the union of their digests"""
+    for name, digests in stats['digests'].items():
+        stats['digests'][name] = sorted(set(digests))
+        stats['distinct_' + name] = len(stats['digests'][name])
+
+
+class DriftStore(object):
+    """Keeps the drifts of one category in memory and writes them out in
+    bulk instead of rewriting drifts_{category}.json for every drift found.
+    It is safe to share between scan workers.
+    With `columnar`, every write also updates the compressed columnar copy
+    of the file (see drift_format).
+    """
+
+    def __init__(self, category, flush_interval=300, path=None,
+                 columnar=False):
+        self.category = category
+        self.path = path or 'drifts_{}.json'.format(category)
+        self.flush_interval = flush_interval
+        self.columnar = columnar
+        self.metadata = {}
+        self.drifts = defaultdict(lambda: defaultdict(set))
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+
+    def add(self, drift, shard, entry):
+        with self._lock:
+            self.drifts[drift][shard].add(entry)
+            if self.flush_interval and \
+                    time.time() - self._last_flush > self.flush_interval:
+                self.flush()
+
+    def to_dict(self):
+        with self._lock:
+            drifts = {'_metadata': dict(self.metadata)}
+            for drift in self.drifts:
+                drifts[drift] = {
+                    shard: sorted(entries)
+                    for shard, entries in self.drifts[drift].items()
+                }
+            return drifts
+
+    def flush(self):
+        with self._lock, timings.measure('write'):
+            drifts = self.to_dict()
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(drifts, indent=4, sort_keys=True))
+            if self.columnar:
+                metadata = drifts.pop('_metadata')
+                write_columnar(columnar_path(self.path), metadata, drifts)
+            self._last_flush = time.time()
+
+    def merge(self, drifts):
+        """Adds the content of another drifts file, like the partial ones
+        written by the workers of a sharded run"""
+        with self._lock:
+            for key, value in drifts.get('_metadata', {}).items():
+                if key in ('shard', 'category'):
+                    continue
+                if key == 'time_start':
+                    value = min(value, self.metadata.get(key, value))
+                elif key in ('time_end', 'memory_peak'):
+                    value = max(value, self.metadata.get(key, value))
+                elif isinstance(value, list):
+                    value = self.metadata.get(key, []) + value
+                elif isinstance(value, dict):
+                    # Counters, like the cache stats or the timings
+                    value = _merge_counters(self.metadata.get(key, {}), value)
+                    if 'digests' in value:
+                        _count_distinct(value)
+                self.metadata[key] = value
+            for drift in drifts:
+                if drift == '_metadata':
+                    continue
+                for shard, entries in drifts[drift].items():
+                    self.drifts[drift][shard].update(entries)
+
+
+class DriftRecorder(object):
+    """Stand-in for a DriftStore that only remembers which drifts were
+    reported, so they can be replayed for other hosts later."""
+
+    def __init__(self):
+        self.drifts = []
+
+    def add(self, drift, shard, entry):
+        self.drifts.append(drift)
+
+
+class ComparisonCache(object):
+    """Drifts found per (expected table, fingerprint of the actual table).
+
+    Most wikis and hosts of a section have the exact same schema, so the
+    comparison only needs to run once for every distinct fingerprint.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(actual_table):
+        # Order is kept on purpose, the comparison depends on it
+        hash_ = hashlib.sha1()
+        for row in actual_table:
+            if 'COLUMN_COMMENT' in row:
+                values = ('c', row['COLUMN_NAME'], row['COLUMN_TYPE'],
+                          row['IS_NULLABLE'], row['EXTRA'])
+            elif 'INDEX_NAME' in row:
+                values = ('i', row['INDEX_NAME'], row['NON_UNIQUE'],
+                          row['COLUMN_NAME'])
+            else:
+                continue
+            hash_.update('\0'.join(values).encode('utf-8'))
+            hash_.update(b'\n')
+        return hash_.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            drifts = self._cache.get(key)
+            if drifts is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return drifts
+
+    def set(self, key, drifts):
+        drifts = tuple(drifts)
+        with self._lock:
+            self._cache[key] = drifts
+        return drifts
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class CategoryRun(object):
+    """Everything needed to check one category during a run: its expected
+    tables, where its drifts go and which wikis it applies to."""
+
+    def __init__(self, name, tables, store: DriftStore, cache=None,
+                 dblist=None, engine=None, schema_hash=None):
+        self.name = name
+        self.tables = tables
+        # Changes whenever the expected schema does
+        self.schema_hash = schema_hash
+        self.store = store
+        self.cache = cache
+        self.dblist = dblist
+        # ComparisonEngine, to compare whole hosts at once instead of table
+        # by table
+        self.engine = engine
+        # Filled in for categories limited to a dblist, None means all wikis
+        self.wikis = None
+
+    def applies_to(self, wiki):
+        return self.wikis is None or wiki in self.wikis
 
 
 class Checker(object):
-    def __init__(self, db: Db, table_name, piece_name, category):
+    def __init__(self, db: Db, table_name, piece_name, store: DriftStore):
         self.db = db
         self.table_name = table_name
         self.piece_name = piece_name
-        self.category = category
+        self.store = store
 
     def run_check(self, drift_type, check):
         if not check:
@@ -19,25 +208,17 @@ class Checker(object):
 
     def _report(self, drift_type):
         drift = ' '.join([self.table_name, self.piece_name, drift_type])
-        shard = self.db.section
-        with open('drifts_{}.json'.format(self.category), 'r') as f:
-            drifts = json.loads(f.read())
-
-        if drift not in drifts:
-            drifts[drift] = {}
-        if shard not in drifts[drift]:
-            drifts[drift][shard] = []
-        drifts[drift][shard].append('%s:%s' % (self.db.host, self.db.wiki))
-
-        with open('drifts_{}.json'.format(self.category), 'w') as f:
-            f.write(json.dumps(drifts, indent=4, sort_keys=True))
+        self.store.add(
+            drift,
+            self.db.section,
+            '%s:%s' % (self.db.host, self.db.wiki))
 
 
 class CheckerFactory():
-    def __init__(self, db: Db, category, table_name):
+    def __init__(self, db: Db, store: DriftStore, table_name):
         self.db = db
-        self.category = category
+        self.store = store
         self.table_name = table_name
 
     def get_checker(self,  piece_name):
-        return Checker(self.db, self.table_name, piece_name, self.category)
+        return Checker(self.db, self.table_name, piece_name, self.store)
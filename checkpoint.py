@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+
+
+class Checkpoint(object):
+    """Append-only journal of the (host, wiki) pairs checked during a run,
+    with the drifts found on each of them.
+
+    With `resume`, the journal of an interrupted run is picked up again and
+    the pairs in it are not checked a second time. Once a run finishes, its
+    journal is kept as `<path>.previous` so that an `incremental` run can
+    reuse the results of hosts whose schema version did not change, as long
+    as the expected schema of the categories didn't change either.
+    Without `enabled` nothing is read or written.
+    """
+
+    def __init__(self, path, resume=False, incremental=False, enabled=True):
+        self.path = path
+        self.resume = resume
+        self.incremental = incremental
+        self.enabled = enabled or resume or incremental
+        self.schemas = {}
+        self.time_start = None
+        self.resumed = 0
+        self.unchanged = 0
+        self._done = {}
+        self._previous = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(path):
+        header = None
+        records = {}
+        if not os.path.exists(path):
+            return header, records
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line of a journal of a run that got killed
+                    continue
+                if '_run' in record:
+                    header = record['_run']
+                    continue
+                records[(record['host'], record['wiki'])] = record
+        return header, records
+
+    def start(self, categories, schemas=None):
+        """Starts the journal, `schemas` being the hash of the expected
+        schema of every category"""
+        self.schemas = schemas or {}
+        if not self.enabled:
+            self.time_start = time.time()
+            return
+        if self.incremental:
+            _, self._previous = self._load(self.path + '.previous')
+        if self.resume:
+            header, self._done = self._load(self.path)
+            if header is not None:
+                if sorted(header['categories']) != sorted(categories):
+                    raise Exception(
+                        'Checkpoint %s was made for categories %s' % (
+                            self.path, ', '.join(header['categories'])))
+                self.time_start = header['time_start']
+                self._file = open(self.path, 'a+')
+                self._file.seek(0, os.SEEK_END)
+                if self._file.tell():
+                    # Don't glue new records onto a half written line
+                    self._file.seek(self._file.tell() - 1)
+                    if self._file.read(1) != '\n':
+                        self._file.write('\n')
+                return
+        self.time_start = time.time()
+        self._file = open(self.path, 'w')
+        self._write({'_run': {
+            'categories': categories, 'time_start': self.time_start}})
+
+    def _write(self, record):
+        if self._file is None:
+            return
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def done_records(self):
+        """Records of the interrupted run being resumed"""
+        self.resumed = len(self._done)
+        return list(self._done.values())
+
+    def is_done(self, host, wiki):
+        return (host, wiki) in self._done
+
+    def get_unchanged(self, host, wiki, version, categories):
+        """Record of the previous run for this wiki on this host if its
+        schema version is still the same and it covers all categories, with
+        the same expected schema"""
+        if not self.incremental or version is None:
+            return None
+        record = self._previous.get((host, wiki))
+        if record is None or record.get('version') != version:
+            return None
+        schemas = record.get('schemas', {})
+        for category in categories:
+            if category not in record['drifts']:
+                return None
+            if schemas.get(category) != self.schemas.get(category):
+                return None
+        with self._lock:
+            self.unchanged += 1
+        return record
+
+    def record(self, section, host, wiki, version, drifts):
+        self._write({
+            'section': section,
+            'host': host,
+            'wiki': wiki,
+            'version': version,
+            'schemas': {category: self.schemas.get(category) for category in drifts},
+            'drifts': drifts,
+        })
+
+    def stats(self):
+        return {'resumed': self.resumed, 'unchanged': self.unchanged}
+
+    def finish(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.replace(self.path, self.path + '.previous')
@@ -0,0 +1,177 @@
+"""Fleet-wide comparison of actual tables with their expected schema.
+
+The rows of any number of wikis are loaded into a SchemaFrame, a set of
+parallel lists (one per attribute, like the columns of a dataframe), and
+compared in a few passes over it. Checks only depend on the value of a
+handful of attributes, and across a fleet these take very few distinct
+values: most wikis have the exact same `page_title varbinary(255) NO`
+column, and most tables the exact same columns and indexes. Rows and tables
+are dictionary encoded, and drifts are computed (by diff_tables, like for
+a single table) once per distinct table, every other one only costs a dict
+lookup.
+"""
+import hashlib
+import json
+import threading
+
+from domain.information_schema import build_table, column_from_row, diff_tables
+from domain.table import Table
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value).encode('utf-8')).hexdigest()[:16]
+
+
+class SchemaFrame(object):
+    """Column and index rows of several wikis in columnar form.
+
+    Every distinct column row (name, type, nullability, extra) and index row
+    (name, uniqueness, column) gets an integer code from the engine, shared
+    by the whole fleet. A table of a wiki, a group, then comes down to the
+    tuple of the codes of its column rows and the one of its index rows.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.group_wiki = []
+        self.group_table = []
+        self.group_columns = []
+        self.group_indexes = []
+
+    def add(self, wiki, data_):
+        """Adds the rows of a wiki, grouped by table, for the tables of the
+        expected schema"""
+        engine = self.engine
+        known_column = engine.column_codes.get
+        known_index = engine.index_codes.get
+        for table in engine.tables:
+            if table.name == 'searchindex' or table.name not in data_:
+                continue
+            columns = []
+            indexes = []
+            for row in data_[table.name]:
+                if 'COLUMN_COMMENT' in row:
+                    value = (row['COLUMN_NAME'], row['COLUMN_TYPE'],
+                             row['IS_NULLABLE'], row['EXTRA'])
+                    code = known_column(value)
+                    columns.append(engine.column_code(value) if code is None else code)
+                if 'INDEX_NAME' in row:
+                    value = (row['INDEX_NAME'], row['NON_UNIQUE'], row['COLUMN_NAME'])
+                    code = known_index(value)
+                    indexes.append(engine.index_code(value) if code is None else code)
+            self.group_wiki.append(wiki)
+            self.group_table.append(table)
+            self.group_columns.append(tuple(columns))
+            self.group_indexes.append(tuple(indexes))
+
+
+class ComparisonEngine(object):
+    """Compares SchemaFrames with the expected tables of a category.
+
+    Drifts are computed once per distinct group (table, column codes,
+    index codes) unless `memo` is off, and every distinct column is only
+    parsed once, so the engine gets cheaper the more of the fleet it goes
+    through. It is safe to share between scan workers.
+    """
+
+    def __init__(self, tables, memo=True):
+        self.tables = tables
+        self.memo = memo
+        self.rows = 0
+        self.groups = 0
+        self.column_codes = {}
+        self._column_values = []
+        self._columns = []
+        self.index_codes = {}
+        self._index_values = []
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def frame(self):
+        return SchemaFrame(self)
+
+    def column_code(self, row):
+        code = self.column_codes.get(row)
+        if code is None:
+            with self._lock:
+                code = self.column_codes.get(row)
+                if code is None:
+                    name, column_type, nullable, extra = row
+                    self._columns.append(
+                        (name, column_from_row(column_type, nullable, extra)))
+                    self._column_values.append(row)
+                    code = self.column_codes[row] = len(self._column_values) - 1
+        return code
+
+    def index_code(self, row):
+        code = self.index_codes.get(row)
+        if code is None:
+            with self._lock:
+                code = self.index_codes.get(row)
+                if code is None:
+                    self._index_values.append(row)
+                    code = self.index_codes[row] = len(self._index_values) - 1
+        return code
+
+    def _group_drifts(self, table: Table, columns, indexes):
+        if not columns or not indexes:
+            print('no response')
+            return ()
+        actual = build_table(
+            table.name,
+            [self._columns[code] for code in columns],
+            [self._index_values[code] for code in indexes])
+        return tuple(
+            ' '.join([table.name, piece_name, drift_type])
+            for piece_name, drift_type in diff_tables(table, actual))
+
+    def compare(self, frame: SchemaFrame):
+        """Returns the drifts found per wiki of the frame"""
+        found = {}
+        known = self._groups
+        rows = 0
+        for wiki, table, columns, indexes in zip(
+                frame.group_wiki, frame.group_table, frame.group_columns,
+                frame.group_indexes):
+            drifts = found.setdefault(wiki, [])
+            key = (table, columns, indexes)
+            group_drifts = known.get(key)
+            if group_drifts is None:
+                group_drifts = self._group_drifts(table, columns, indexes)
+                if self.memo:
+                    with self._lock:
+                        known[key] = group_drifts
+            elif not columns or not indexes:
+                print('no response')
+            drifts += group_drifts
+            rows += len(columns) + len(indexes)
+        with self._lock:
+            self.rows += rows
+            self.groups += len(frame.group_wiki)
+        return found
+
+    def digests(self):
+        """Digests of the distinct tables, columns and indexes seen, so
+        that the distinct counts of the shards of a run can be merged"""
+        with self._lock:
+            columns = [_digest(row) for row in self._column_values]
+            indexes = [_digest(row) for row in self._index_values]
+            tables = [
+                _digest([table.name, [columns[i] for i in table_columns],
+                         [indexes[i] for i in table_indexes]])
+                for table, table_columns, table_indexes in self._groups]
+        return {
+            'tables': sorted(tables),
+            'columns': sorted(columns),
+            'indexes': sorted(indexes),
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rows': self.rows,
+                'tables': self.groups,
+                'distinct_tables': len(self._groups),
+                'distinct_columns': len(self._column_values),
+                'distinct_indexes': len(self._index_values),
+            }
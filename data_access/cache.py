@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+from instrumentation import timings
+
+from . import http_client
+
+
+class OfflineCacheMiss(Exception):
+    pass
+
+
+class HttpCache(object):
+    """Content-addressed local cache of remote files.
+
+    Bodies are stored under objects/ named after their sha256, and every
+    url gets a small index entry pointing to its current body along with
+    the validators (ETag, Last-Modified) needed to revalidate it. Entries
+    younger than `ttl` seconds are used as is; older ones are revalidated
+    with a conditional request. In offline mode nothing is requested and
+    everything has to come from the cache.
+    """
+
+    def __init__(self, directory='~/.cache/db-analyzor-tools', ttl=3600,
+                 offline=False):
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+        self.offline = offline
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, 'index'), exist_ok=True)
+
+    def _index_path(self, url):
+        return os.path.join(
+            self.directory, 'index',
+            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    def _read_entry(self, url):
+        try:
+            with open(self._index_path(url), 'r') as f:
+                entry = json.loads(f.read())
+            with open(self._object_path(entry['content']), 'rb') as f:
+                return entry, f.read()
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    @staticmethod
+    def _write_atomic(path, data):
+        tmp_path = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _write_entry(self, url, entry, body=None):
+        with self._lock:
+            if body is not None:
+                entry['content'] = hashlib.sha256(body).hexdigest()
+                object_path = self._object_path(entry['content'])
+                if not os.path.exists(object_path):
+                    self._write_atomic(object_path, body)
+            self._write_atomic(
+                self._index_path(url),
+                json.dumps(entry, sort_keys=True).encode('utf-8'))
+
+    def _request(self, url, headers):
+        with timings.measure('fetch'):
+            return http_client.get(url, headers=headers)
+
+    def put(self, url, body):
+        """Stores body as the current content of url"""
+        self._write_entry(url, {'url': url, 'fetched_at': time.time()}, body)
+
+    def get(self, url):
+        """Returns the body of url as bytes"""
+        entry, body = self._read_entry(url)
+        if self.offline:
+            if body is None:
+                raise OfflineCacheMiss('%s is not in the cache' % url)
+            return body
+        if body is not None and time.time() - entry['fetched_at'] < self.ttl:
+            return body
+
+        headers = {}
+        if body is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            res = self._request(url, headers)
+        except requests.RequestException:
+            # A stale copy is better than nothing
+            if body is not None:
+                return body
+            raise
+        if res.status_code == 304 and body is not None:
+            entry['fetched_at'] = time.time()
+            self._write_entry(url, entry)
+            return body
+        res.raise_for_status()
+        entry = {
+            'url': url,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'fetched_at': time.time(),
+        }
+        self._write_entry(url, entry, res.content)
+        return res.content
+
+
+_cache = None
+# Only used when there is no cache, to hand prefetched files over to fetch()
+_prefetched = {}
+_prefetched_lock = threading.Lock()
+
+
+def configure_cache(directory='~/.cache/db-analyzor-tools', ttl=3600,
+                    offline=False, enabled=True):
+    global _cache
+    _cache = HttpCache(directory, ttl, offline) if enabled else None
+
+
+def fetch(url):
+    """Body of url as bytes, through the cache if one is configured"""
+    if _cache is None:
+        with _prefetched_lock:
+            if url in _prefetched:
+                return _prefetched[url]
+        return _download(url)
+    return _cache.get(url)
+
+
+def _download(url):
+    with timings.measure('fetch'):
+        res = http_client.get(url)
+    res.raise_for_status()
+    return res.content
+
+
+def prefetch(urls, jobs=8):
+    """Downloads all of the urls in parallel so that later calls to
+    fetch() for them don't have to wait on the network. Failures are
+    ignored here, fetch() will run into them again and report them."""
+    fetcher = _download if _cache is None else _cache.get
+
+    def try_fetch(url):
+        try:
+            return fetcher(url)
+        except Exception:
+            return None
+    bodies = http_client.fetch_all(urls, try_fetch, jobs)
+    if _cache is None:
+        with _prefetched_lock:
+            _prefetched.update(
+                (url, body) for url, body in bodies.items() if body is not None)
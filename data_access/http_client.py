@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) in seconds
+DEFAULT_TIMEOUT = (5, 60)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Process-wide session, so connections to gerrit/noc are kept alive
+    and failed requests are retried with a backoff."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=4,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504))
+            adapter = HTTPAdapter(
+                pool_connections=8, pool_maxsize=32, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def get(url, headers=None, timeout=DEFAULT_TIMEOUT):
+    return get_session().get(url, headers=headers, timeout=timeout)
+
+
+def fetch_all(urls, fetcher, jobs=8):
+    """Runs fetcher(url) for all urls in parallel, returns {url: result}"""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(jobs, len(urls))) as executor:
+        return dict(zip(urls, executor.map(fetcher, urls)))
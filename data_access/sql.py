@@ -1,9 +1,26 @@
+import os
 import re
 import sys
-from subprocess import PIPE, TimeoutExpired, run
+import tempfile
+import threading
+import time
+from subprocess import PIPE, Popen
 
+from instrumentation import timings
 
-def get_table_structure_sql(host, sql_command, db, dc, skip_host):
+try:
+    import pymysql
+    import pymysql.cursors
+except ImportError:
+    pymysql = None
+
+
+class QueryError(Exception):
+    """The host could not be queried, because it timed out, refused the
+    connection or the query failed"""
+
+
+def _build_sql_command(host, sql_command, dc, skip_host):
     port = None
     if host != 'localhost':
         if re.search(r' \-\-(?: |$)', sql_command):
@@ -17,29 +34,322 @@ def get_table_structure_sql(host, sql_command, db, dc, skip_host):
         sql_command += ' -P ' + port
     if not skip_host:
         sql_command += '-h ' + host
-    command = 'timeout 6 {} -e ' + \
-        '"select * FROM information_schema.columns WHERE table_schema = \'{}\'\\G; ' + \
-        'SELECT * FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA = \'{}\'\\G;"'
-    command = command.format(sql_command, db, db)
-    try:
-        res = run(
-            command,
-            stdin=PIPE,
-            stdout=PIPE,
-            shell=True,
-            stderr=PIPE,
-            timeout=5)
-    except TimeoutExpired:
-        try:
-            res = run(
+    return sql_command
+
+
+# What the mysql client prints before every row, values can start with '*'
+_row_header = re.compile(r'\*+ \d+\. row \*+$')
+
+
+def iter_vertical_rows(lines):
+    """Parses the vertical (\\G) output of the mysql client line by line,
+    yielding a dict per row as soon as the row is complete."""
+    row = None
+    for line in lines:
+        if line.startswith('*') and _row_header.match(line):
+            if row:
+                yield row
+            row = {}
+            continue
+        if row is None:
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key = key.strip()
+        if not key.replace('_', '').isalpha() or not key.isupper():
+            # Continuation of a multi-line value
+            continue
+        row[key] = value.strip(' \n')
+    if row:
+        yield row
+
+
+def _schema_versions(rows):
+    # CREATE_TIME changes on every ALTER TABLE, UPDATE_TIME changes on every
+    # write so it's not usable to tell if the schema changed.
+    return {
+        row['TABLE_SCHEMA']: '{}:{}'.format(row['TABLES'], row['CREATE_TIME'])
+        for row in rows
+    }
+
+
+def get_schema_versions_sql(host, sql_command, dbs, dc, skip_host, timeout=5):
+    sql_command = _build_sql_command(host, sql_command, dc, skip_host)
+    schemas = ', '.join('\'{}\''.format(db) for db in dbs)
+    query = 'SELECT TABLE_SCHEMA, COUNT(*) AS TABLES, MAX(CREATE_TIME) AS CREATE_TIME ' + \
+        'FROM information_schema.tables WHERE TABLE_SCHEMA IN ({}) GROUP BY TABLE_SCHEMA\\G;'
+    return _schema_versions(_run_query(sql_command, query.format(schemas), timeout))
+
+
+def parse_table_structure(res):
+    """Turns the vertical output of the mysql client into a dict per row"""
+    return iter_vertical_rows(res.split('\n'))
+
+
+def _stream_query(command, timeout):
+    timed_out = threading.Event()
+    with tempfile.TemporaryFile() as stderr:
+        with timings.measure('spawn'):
+            process = Popen(
                 command,
                 stdin=PIPE,
                 stdout=PIPE,
                 shell=True,
-                stderr=PIPE,
-                timeout=5)
-        except BaseException:
-            return ''
-    if res.stderr and res.stderr.decode('utf-8'):
-        return ''
-    return res.stdout.decode('utf-8')
+                stderr=stderr,
+                encoding='utf-8')
+
+        def kill():
+            timed_out.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            # Waiting on the pipe costs no cpu time, parsing it does
+            cpu_start = time.thread_time()
+            rows = list(iter_vertical_rows(process.stdout))
+            timings.add('parse', time.thread_time() - cpu_start)
+            process.wait()
+        finally:
+            timer.cancel()
+            process.stdout.close()
+        # 124 is the exit code of timeout(1)
+        if timed_out.is_set() or process.returncode == 124:
+            raise QueryError('timed out after {}s'.format(timeout))
+        stderr.seek(0)
+        error = stderr.read().decode('utf-8', 'replace').strip()
+        if error:
+            raise QueryError(error.split('\n')[-1])
+    return rows
+
+
+def _run_query(sql_command, query, timeout):
+    command = 'timeout {} {} -e "{}"'.format(timeout + 1, sql_command, query)
+    return _stream_query(command, timeout)
+
+
+def get_table_structure_sql(host, sql_command, db, dc, skip_host, timeout=5):
+    sql_command = _build_sql_command(host, sql_command, dc, skip_host)
+    query = 'select * FROM information_schema.columns WHERE table_schema = \'{}\'\\G; ' + \
+        'SELECT * FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA = \'{}\'\\G;'
+    return _run_query(sql_command, query.format(db, db), timeout)
+
+
+def _by_schema(rows, dbs):
+    rows_by_db = {db: [] for db in dbs}
+    for row in rows:
+        if row.get('TABLE_SCHEMA') in rows_by_db:
+            rows_by_db[row['TABLE_SCHEMA']].append(row)
+    return rows_by_db
+
+
+# Linux refuses single arguments longer than 128KB (MAX_ARG_STRLEN)
+MAX_QUERY_LENGTH = 64 * 1024
+
+
+def get_each_table_structure_sql(host, sql_command, dbs, dc, skip_host, timeout=60):
+    """The queries of get_table_structure_sql for every database, back to
+    back in a single session of the client, or a few of them if they don't
+    fit in one command line. Returns the rows per database."""
+    sql_command = _build_sql_command(host, sql_command, dc, skip_host)
+    statements = [
+        'select * FROM information_schema.columns WHERE table_schema = \'{0}\'\\G; '
+        'SELECT * FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA = \'{0}\'\\G;'.format(db)
+        for db in dbs]
+    rows = []
+    batch = []
+    length = 0
+    for statement in statements:
+        if batch and length + len(statement) > MAX_QUERY_LENGTH:
+            rows += _run_query(sql_command, ' '.join(batch), timeout)
+            batch = []
+            length = 0
+        batch.append(statement)
+        length += len(statement) + 1
+    if batch:
+        rows += _run_query(sql_command, ' '.join(batch), timeout)
+    return _by_schema(rows, dbs)
+
+
+def get_tables_structure_sql(host, sql_command, dbs, dc, skip_host, timeout=60):
+    """Same as get_table_structure_sql but for all of the given databases
+    of a host in one go, rows can be told apart by TABLE_SCHEMA."""
+    sql_command = _build_sql_command(host, sql_command, dc, skip_host)
+    schemas = ', '.join('\'{}\''.format(db) for db in dbs)
+    query = 'select * FROM information_schema.columns WHERE table_schema IN ({})\\G; ' + \
+        'SELECT * FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA IN ({})\\G;'
+    return _run_query(sql_command, query.format(schemas, schemas), timeout)
+
+
+class CliBackend(object):
+    """Shells out to the mysql client (or a wrapper like `sql`) per query"""
+
+    def __init__(self, dc, skip_host):
+        self.dc = dc
+        self.skip_host = skip_host
+
+    def get_table_structure(self, host, sql_command, db, timeout=5):
+        return get_table_structure_sql(
+            host, sql_command, db, self.dc, self.skip_host, timeout)
+
+    def get_tables_structure(self, host, sql_command, dbs, timeout=60):
+        return get_tables_structure_sql(
+            host, sql_command, dbs, self.dc, self.skip_host, timeout)
+
+    def get_each_table_structure(self, host, sql_command, dbs, timeout=60):
+        return get_each_table_structure_sql(
+            host, sql_command, dbs, self.dc, self.skip_host, timeout)
+
+    def get_schema_versions(self, host, sql_command, dbs, timeout=5):
+        return get_schema_versions_sql(
+            host, sql_command, dbs, self.dc, self.skip_host, timeout)
+
+    def close(self):
+        pass
+
+
+class DbApiBackend(object):
+    """Talks to the hosts directly through a DB-API driver, keeping the
+    connections open between queries.
+
+    Rows are returned with the same string values the mysql client prints
+    so the comparison code doesn't need to care about the backend.
+    `connect` can be any callable taking (host, port, timeout) and returning
+    a DB-API connection using the "format" paramstyle. Connections are
+    pooled per host and reused with the timeout of every query, through the
+    `_read_timeout` attribute PyMySQL reads before each read from the
+    socket; connections without it keep the timeout they were opened with.
+    benchmarks/fake_dbapi.py is a SQLite backed stand-in for the hosts.
+    """
+
+    columns_query = 'SELECT * FROM information_schema.columns WHERE table_schema IN ({})'
+    statistics_query = 'SELECT * FROM information_schema.statistics WHERE table_schema IN ({})'
+    versions_query = 'SELECT TABLE_SCHEMA, COUNT(*) AS TABLES, MAX(CREATE_TIME) AS CREATE_TIME ' + \
+        'FROM information_schema.tables WHERE TABLE_SCHEMA IN ({}) GROUP BY TABLE_SCHEMA'
+
+    def __init__(self, dc, connect=None, config_file='~/.my.cnf'):
+        if connect is None:
+            if pymysql is None:
+                raise Exception('The pymysql backend requires PyMySQL to be installed')
+            connect = self._connect_pymysql
+        self.dc = dc
+        self.config_file = os.path.expanduser(config_file)
+        self._connect = connect
+        self._pool = {}
+        self._lock = threading.Lock()
+
+    def _connect_pymysql(self, host, port, timeout):
+        kwargs = {
+            'host': host,
+            'connect_timeout': timeout,
+            'read_timeout': timeout,
+            'cursorclass': pymysql.cursors.DictCursor,
+        }
+        if port:
+            kwargs['port'] = port
+        if os.path.exists(self.config_file):
+            kwargs['read_default_file'] = self.config_file
+        return pymysql.connect(**kwargs)
+
+    def _address(self, host):
+        if host == 'localhost':
+            return host, None
+        port = None
+        if ':' in host:
+            host, port = host.split(':')
+            port = int(port)
+        return '{}.{}.wmnet'.format(host, self.dc), port
+
+    def _acquire(self, host, timeout):
+        with self._lock:
+            idle = self._pool.setdefault(host, [])
+            if idle:
+                return idle.pop()
+        return self._connect(*self._address(host), timeout)
+
+    def _release(self, host, connection):
+        with self._lock:
+            self._pool.setdefault(host, []).append(connection)
+
+    @staticmethod
+    def _normalize(row):
+        normalized = {}
+        for key, value in row.items():
+            if value is None:
+                value = 'NULL'
+            elif isinstance(value, bytes):
+                value = value.decode('utf-8')
+            normalized[key.upper()] = str(value)
+        return normalized
+
+    def _query(self, connection, queries, dbs):
+        placeholders = ', '.join(['%s'] * len(dbs))
+        rows = []
+        for query in queries:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query.format(placeholders), list(dbs))
+                columns = [i[0] for i in cursor.description]
+                for row in cursor.fetchall():
+                    if not isinstance(row, dict):
+                        row = dict(zip(columns, row))
+                    rows.append(self._normalize(row))
+            finally:
+                cursor.close()
+        return rows
+
+    def _run(self, host, queries, dbs, timeout):
+        return self._session(
+            host, timeout, lambda connection: self._query(connection, queries, dbs))
+
+    def _session(self, host, timeout, func):
+        try:
+            connection = self._acquire(host, timeout)
+        except Exception as e:
+            raise QueryError('could not connect: {}'.format(e))
+        if hasattr(connection, '_read_timeout'):
+            connection._read_timeout = timeout
+        try:
+            rows = func(connection)
+        except Exception as e:
+            try:
+                connection.close()
+            except Exception:
+                pass
+            raise QueryError(str(e))
+        self._release(host, connection)
+        return rows
+
+    def get_tables_structure(self, host, sql_command, dbs, timeout=60):
+        return self._run(
+            host, (self.columns_query, self.statistics_query), dbs, timeout)
+
+    def get_table_structure(self, host, sql_command, db, timeout=5):
+        return self.get_tables_structure(host, sql_command, [db], timeout)
+
+    def get_each_table_structure(self, host, sql_command, dbs, timeout=60):
+        queries = (self.columns_query, self.statistics_query)
+        return self._session(host, timeout, lambda connection: {
+            db: self._query(connection, queries, [db]) for db in dbs})
+
+    def get_schema_versions(self, host, sql_command, dbs, timeout=5):
+        return _schema_versions(
+            self._run(host, (self.versions_query,), dbs, timeout))
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for connections in pool.values():
+            for connection in connections:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+
+def get_backend(name, dc, skip_host, config_file='~/.my.cnf'):
+    if name == 'cli':
+        return CliBackend(dc, skip_host)
+    if name == 'pymysql':
+        return DbApiBackend(dc, config_file=config_file)
+    raise Exception('Unknown sql backend %s' % name)
@@ -1,24 +1,33 @@
 import base64
+import json
 import random
 import sys
 
-import requests
+from .cache import fetch, prefetch
 
 
 class Gerrit(object):
     def __init__(self):
         self.url = 'https://gerrit.wikimedia.org/g/'
 
+    def get_url(self, path):
+        return '{0}{1}?format=TEXT'.format(self.url, path)
+
     def get_file(self, path):
-        url = '{0}{1}?format=TEXT'.format(self.url, path)
-        return base64.b64decode(requests.get(url).text).decode('utf-8')
+        return base64.b64decode(fetch(self.get_url(path))).decode('utf-8')
+
+    def prefetch_files(self, paths):
+        prefetch([self.get_url(path) for path in paths])
+
+
+def get_dblist_path(dblist):
+    return 'operations/mediawiki-config/+/master/dblists/{dblist}.dblist'.format(
+        dblist=dblist)
 
 
 def get_wikis_from_dblist(dblist, all_=False):
     gerrit = Gerrit()
-    file_ = gerrit.get_file(
-        'operations/mediawiki-config/+/master/dblists/{dblist}.dblist'.format(
-            dblist=dblist))
+    file_ = gerrit.get_file(get_dblist_path(dblist))
     dbs = file_.split('\n')
     random.shuffle(dbs)
     dbs_returning = []
@@ -33,8 +42,11 @@ def get_wikis_from_dblist(dblist, all_=False):
 
 def get_shard_mapping(dc):
     shard_mapping = {'hosts': {}, 'wikis': {}}
-    db_data = requests.get(
-        'https://noc.wikimedia.org/dbconfig/{}.json'.format(dc)).json()
+    db_data = json.loads(fetch(
+        'https://noc.wikimedia.org/dbconfig/{}.json'.format(dc)))
+    Gerrit().prefetch_files([
+        get_dblist_path('s3' if shard == 'DEFAULT' else shard)
+        for shard in db_data['sectionLoads']])
     for shard in db_data['sectionLoads']:
         cases = []
         if shard == 'DEFAULT':
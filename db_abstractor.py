@@ -1,115 +1,240 @@
 #!/usr/bin/python3
 
 import base64
+import concurrent.futures
+import glob
 import json
+import os
 import random
 import re
 import subprocess
 import sys
+import textwrap
 import time
 from collections import defaultdict
 from optparse import OptionParser
 
-import requests
+from data_access import http_client
+from data_access.sql import iter_vertical_rows
+from domain.information_schema import abstract_table
+
+
+# A token with the whitespace and comments before it, so that a single
+# findall() goes through the whole input. Anything that is not a known token,
+# like an unterminated string, ends up as a one character "other" token.
+_token_re = re.compile(r"""
+    ((?:\s+|--[^\n]*|/\*.*?\*/)*)
+    (?:
+        ('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+      | `([^`]*)`
+      | ((?:[^\s()',;"`/-]|/(?!\*)|-(?!-))+)
+      | ([(),;])
+      | (.)
+    )
+""", re.VERBOSE | re.DOTALL)
+
+
+def _statements(sql):
+    """Splits sql into statements, each a list of (text, spaced) tokens,
+    spaced telling whether whitespace or a comment came before the token.
+    Everything is lowercased and identifiers lose their backticks."""
+    statement = []
+    depth = 0
+    for gap, string, quoted, word, punct, other in _token_re.findall(sql.lower()):
+        if punct:
+            if punct == ';' and depth == 0:
+                if statement:
+                    yield statement
+                statement = []
+                continue
+            if punct == '(':
+                depth += 1
+            elif punct == ')':
+                depth = max(0, depth - 1)
+        statement.append((word or punct or string or quoted or other, bool(gap)))
+    if statement:
+        yield statement
+
+
+def _text(tokens):
+    """Tokens back to text, with a single space wherever there was any
+    whitespace or comment"""
+    return ''.join(
+        ' ' + text if spaced and i else text
+        for i, (text, spaced) in enumerate(tokens))
+
+
+def _group(tokens, start):
+    """Tokens inside the parentheses opening at start, and the position
+    right after the closing one"""
+    depth = 0
+    for i in range(start, len(tokens)):
+        text = tokens[i][0]
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+            if depth == 0:
+                return tokens[start + 1:i], i + 1
+    return tokens[start + 1:], len(tokens)
+
+
+def _split_definitions(tokens):
+    definitions = [[]]
+    depth = 0
+    for token in tokens:
+        text = token[0]
+        if text == ',' and depth == 0:
+            definitions.append([])
+            continue
+        if text == '(':
+            depth += 1
+        elif text == ')':
+            depth -= 1
+        definitions[-1].append(token)
+    return [i for i in definitions if i]
+
+
+def _parse_index(tokens):
+    """Name, uniqueness and columns of an inline KEY/INDEX definition, None
+    if it is not one"""
+    first = tokens[0][0]
+    unique = first == 'unique'
+    if first in ('unique', 'fulltext', 'spatial'):
+        tokens = tokens[1:]
+    if not tokens or tokens[0][0] not in ('key', 'index'):
+        return None
+    if len(tokens) < 3 or tokens[1][0] == '(':
+        # KEY() without a name, there is nothing to call it in the json
+        return False
+    columns, _ = _group(tokens, 2)
+    return tokens[1][0], unique, _text(columns)
+
+
+def _parse_column(line):
+    """Name, structure and whether it is the primary key of a column
+    definition, given as text"""
+    lineSplitSpace = line.split(' ')
+
+    opts = {}
+    pk = False
+    if 'primary key' in line:
+        pk = True
+        if 'auto_increment' in line:
+            opts['autoincrement'] = True
+
+    if lineSplitSpace[1].startswith('enum'):
+        real_type = ' '.join(line.split(')')[0].split(' ')[1:]) + ')'
+        real_type = real_type.replace('"', '\'').replace(' ', '')
+    else:
+        real_type = lineSplitSpace[1]
+
+    if ' unsigned ' in line:
+        line = line.replace(' unsigned ', ' ')
+        opts['unsigned'] = True
+
+    not_null = 'not null' in line
+    if not_null:
+        line = line.replace('not null', ' ')
+    opts['notnull'] = not_null
+
+    if ' default' in line:
+        default = re.findall(r'default +(.+?)(?:\s|$)', line)[0]
+        if '\'' in default:
+            default = str(default).replace('\'', '')
+
+        if default.isnumeric():
+            default = int(default)
+        elif default == 'null':
+            default = None
+
+        opts['default'] = default
+
+    return lineSplitSpace[0], {
+        'type': real_type,
+        'config': ' '.join(lineSplitSpace[2:]),
+        'options': opts,
+    }, pk
+
+
+def _parse_create_table(tokens, result):
+    i = 2
+    if [token[0] for token in tokens[i:i + 3]] == ['if', 'not', 'exists']:
+        i += 3
+    if i + 1 >= len(tokens) or tokens[i + 1][0] != '(':
+        return
+    table_name = tokens[i][0]
+    body, _ = _group(tokens, i + 1)
+
+    table_structure_real = {}
+    indexes = {}
+    pk = None
+    for definition in _split_definitions(body):
+        first = definition[0][0]
+        if first in ('constraint', 'foreign', 'check'):
+            continue
+        if first == 'primary' and len(definition) > 1 and definition[1][0] == 'key':
+            texts = [token[0] for token in definition]
+            if '(' in texts:
+                pk = _text(_group(definition, texts.index('('))[0]).replace(' ', '')
+            continue
+        index = _parse_index(definition)
+        if index is False:
+            continue
+        if index is not None:
+            indexes[index[0]] = {'unique': index[1], 'columns': index[2]}
+            continue
+        if len(definition) < 2:
+            continue
+        line = _text(definition)
+        if re.search(r'key +\(', line):
+            continue
+        name, structure, is_pk = _parse_column(line)
+        if is_pk:
+            pk = name
+        table_structure_real[name] = structure
+
+    result[table_name] = {
+        'structure': table_structure_real,
+        'indexes': indexes,
+    }
+    if pk is not None:
+        result[table_name]['pk'] = pk
+
+
+def _parse_create_index(tokens, pending):
+    i = 1
+    unique = tokens[i][0] == 'unique'
+    while i < len(tokens) and tokens[i][0] in ('unique', 'fulltext', 'spatial'):
+        i += 1
+    if len(tokens) < i + 5 or tokens[i][0] != 'index' or tokens[i + 2][0] != 'on':
+        return
+    columns, _ = _group(tokens, i + 4)
+    pending[tokens[i + 3][0]].append(
+        (tokens[i + 1][0], {'unique': unique, 'columns': _text(columns)}))
 
 
 def parse_sql(sql):
+    """Parses the CREATE TABLE and CREATE INDEX statements of sql into
+    {table: {'structure': {column: ...}, 'indexes': {...}, 'pk': ...}}.
+    Everything else in the input is ignored.
+    """
     result = {}
-    sql = sql.replace('IF NOT EXISTS ', '')
-    sql = re.sub(r'\s*\-\-.*', '', sql)
-
-    for table_chunk in sql.split('CREATE TABLE '):
-        table_chunk = table_chunk.lower()
-        table_chunk = re.sub(r'/\*.+?\*/', '', table_chunk)
-        table_chunk = re.sub(r'\n\s*\n', '\n', table_chunk)
-
-        table_name = table_chunk.split('(')[0].strip()
-
-        if not table_name or '\n' in table_name:
+    pending = defaultdict(list)
+    for tokens in _statements(sql):
+        if len(tokens) < 3 or tokens[0][0] != 'create':
             continue
-        if '(' not in table_chunk:
+        if tokens[1][0] == 'temporary':
+            tokens = tokens[:1] + tokens[2:]
+        if tokens[1][0] == 'table':
+            _parse_create_table(tokens, result)
+        else:
+            _parse_create_index(tokens, pending)
+    for table_name, indexes in pending.items():
+        if table_name not in result:
             continue
-        indexes = {}
-
-        for res in re.findall(r'create( +unique|)(?: +fulltext|) +index +(\S+?)[ \n]+on +%s +\((.+?)\)\;' % table_name, table_chunk):
-            indexes[res[1]] = {'unique': bool(res[0]), 'columns': res[2]}
-
-        table_structure = re.split(
-            r'create( +unique|) +index', '('.join(table_chunk.split('(')[1:]))[0]
-
-        table_structure_real = {}
-
-        pk = None
-        for line in table_structure.split('\n'):
-            line = line.strip()
-            if not line or line.endswith(';'):
-                continue
-
-            # Why strip(',') doesn't work?
-            if line.endswith(','):
-                line = line[:-1]
-
-            line = re.sub(r' +', ' ', line)
-            lineSplitSpace = line.split(' ')
-
-            opts = {}
-            if 'primary key' in line:
-                if line.startswith('primary key'):
-                    pk = line.split('(')[1].split(')')[0].replace(' ', '')
-                    continue
-                else:
-                    pk = lineSplitSpace[0]
-                    if 'auto_increment' in line:
-                        opts['autoincrement'] = True
-
-            # KEY() in CREATE TABLE() doesn't have an index name...
-            # Should probably autogenerate a name, so it can be fixed manually in the json
-            # For now, just skip that line
-            elif re.search('key +\(', line):
-                 continue
-            #elif 'key(' in line:
-            #    indexes[''] = line.split('(')[1].split(')')[0].replace(' ', '')
-
-            if lineSplitSpace[1].startswith('enum'):
-                real_type = ' '.join(line.split(')')[0].split(' ')[1:]) + ')'
-                real_type = real_type.replace('"', '\'').replace(' ', '')
-            else:
-                real_type = lineSplitSpace[1]
-
-            if ' unsigned ' in line:
-                line = line.replace(' unsigned ', ' ')
-                opts['unsigned'] = True
-
-            not_null = 'not null' in line
-            if not_null:
-                line = line.replace('not null', ' ')
-            opts['notnull'] = not_null
-
-            if ' default' in line:
-               default = re.findall('default +(.+?)(?:\s|$)', line)[0]
-               if '\'' in default:
-                   default = str(default).replace('\'', '')
-
-               if default.isnumeric():
-                   default = int(default)
-               elif default == 'null':
-                   default = None
-
-               opts['default'] = default
-
-            table_structure_real[lineSplitSpace[0]] = {
-                'type': real_type,
-                'config': ' '.join(lineSplitSpace[2:]),
-                'options': opts,
-            }
-
-        result[table_name] = {
-           'structure': table_structure_real,
-           'indexes': indexes
-        }
-        if pk is not None:
-            result[table_name]['pk'] = pk
-
+        for index_name, index in indexes:
+            result[table_name]['indexes'][index_name] = index
     return result
 
 gerrit_url = 'https://gerrit.wikimedia.org/g/'
@@ -124,7 +249,7 @@ type_to_path_mapping = {
 
 def get_sql_from_gerrit(type_):
     url = gerrit_url + '{0}?format=TEXT'.format(type_to_path_mapping[type_])
-    return base64.b64decode(requests.get(url).text).decode('utf-8')
+    return base64.b64decode(http_client.get(url).text).decode('utf-8')
 
 def get_type(type_, name):
     split = type_.split(' ')[0]
@@ -163,21 +288,8 @@ def get_type(type_, name):
     return {'type': type_, 'length': length}
 
 
-if __name__ == '__main__':
-    parser = OptionParser()
-    parser.add_option("--sqlfile", help="sql file to process", metavar="FILE")
-
-    opts, args = parser.parse_args()
-
-    # If --sqlfile is passed, parse that, else parse MW core from gerrit (old behaviour)
-    if opts.sqlfile:
-        sqlfile = open(opts.sqlfile,'r')
-        sql = sqlfile.read()
-    else:
-        sql = get_sql_from_gerrit('core')
-
-    parsed = parse_sql(sql)
-
+def abstract_schema(parsed):
+    """Turns the output of parse_sql into the abstract schema format"""
     final_result = []
 
     for table in parsed:
@@ -217,5 +329,270 @@ if __name__ == '__main__':
             table_abstract['pk'] = [ parsed[table]['pk'] ]
 
         final_result.append(table_abstract)
+    return final_result
+
+
+def _input_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def expand_source(source):
+    """Inputs of a --batch source: a directory (every .sql file in it), a
+    glob, a single sql file or a manifest listing one path (relative to the
+    manifest) or gerrit:<type> per line"""
+    if os.path.isdir(source):
+        return [('file', i) for i in sorted(
+            glob.glob(os.path.join(source, '**', '*.sql'), recursive=True))]
+    if glob.has_magic(source):
+        return [('file', i) for i in sorted(glob.glob(source, recursive=True))]
+    if source.endswith('.sql'):
+        return [('file', source)]
+    inputs = []
+    with open(source, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            if line.startswith('gerrit:'):
+                inputs.append(('gerrit', line[len('gerrit:'):]))
+            else:
+                inputs.append(('file', os.path.join(os.path.dirname(source), line)))
+    return inputs
+
+
+def abstract_input(input_):
+    """Abstract schema of a ('file', path) or ('gerrit', type) input, run in
+    the worker processes of the batch mode"""
+    kind, value = input_
+    if kind == 'gerrit':
+        sql = get_sql_from_gerrit(value)
+    else:
+        with open(value, 'r') as f:
+            sql = f.read()
+    return abstract_schema(parse_sql(sql))
+
+
+def _unescape_batch(value):
+    # mysql -B escapes newlines, tabs and backslashes in values
+    return re.sub(
+        r'\\(.)', lambda m: {'n': '\n', 't': '\t', '0': '\0'}.get(m.group(1), m.group(1)),
+        value)
+
+
+def _query_lines(sql_command, database, query, options='-N -B'):
+    command = '{} {} {} -e "{}"'.format(sql_command, database, options, query)
+    process = subprocess.Popen(
+        command, shell=True, stdout=subprocess.PIPE, encoding='utf-8')
+    try:
+        for line in process.stdout:
+            yield line.rstrip('\n')
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise Exception('Query of {} failed: {}'.format(database, command))
+
+
+def abstract_database(sql_command, database):
+    """Abstract schema of the tables of a live database, one table at a time
+    from SHOW CREATE TABLE"""
+    tables = list(_query_lines(sql_command, database, 'SHOW TABLES'))
+    query = ' '.join(
+        'SHOW CREATE TABLE \\`{}\\`;'.format(table.replace('`', '``')) for table in tables)
+    for line in _query_lines(sql_command, database, query):
+        table, sep, create = line.partition('\t')
+        if not sep:
+            continue
+        for table_abstract in abstract_schema(parse_sql(_unescape_batch(create))):
+            yield table_abstract
+
+
+def abstract_database_information_schema(sql_command, database):
+    """Same as abstract_database but from the information_schema rows the
+    drift checker reads. Only the indexes are held in memory, the columns
+    are streamed table by table."""
+    schema = '\'{}\''.format(database.replace('\'', '\'\''))
+    indexes = defaultdict(list)
+    for row in iter_vertical_rows(_query_lines(
+            sql_command, database,
+            'SELECT * FROM information_schema.statistics WHERE table_schema = {} '
+            'ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX\\G'.format(schema), '')):
+        indexes[row['TABLE_NAME']].append(row)
+    table_name = None
+    rows = []
+    for row in iter_vertical_rows(_query_lines(
+            sql_command, database,
+            'SELECT * FROM information_schema.columns WHERE table_schema = {} '
+            'ORDER BY TABLE_NAME, ORDINAL_POSITION\\G'.format(schema), '')):
+        if row['TABLE_NAME'] != table_name:
+            if rows:
+                yield abstract_table(table_name, rows + indexes[table_name])
+            table_name = row['TABLE_NAME']
+            rows = []
+        rows.append(row)
+    if rows:
+        yield abstract_table(table_name, rows + indexes[table_name])
+
+
+class BatchWriter(object):
+    """Writes the abstract schemas either to one <name>.json per input in
+    output_dir or, as {name: schema}, to a single combined file. Schemas are
+    written as they come, once all the tables of the input were read, so an
+    input failing halfway leaves nothing behind. Files only get their name
+    once they are complete."""
+
+    def __init__(self, output_dir=None, output=None):
+        self.output_dir = output_dir
+        self.output = output
+        self._names = set()
+        self._combined = None
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        else:
+            self._combined = open(output + '.tmp', 'w') if output else sys.stdout
+            self._combined.write('{')
+
+    def _open(self, name):
+        self._names.add(name)
+        if self.output_dir:
+            path = os.path.join(self.output_dir, name + '.json')
+            return open(path + '.tmp', 'w'), ''
+        if len(self._names) > 1:
+            self._combined.write(',')
+        self._combined.write('\n\t{}: '.format(json.dumps(name)))
+        return self._combined, '\t'
+
+    def write(self, name, tables):
+        tables = list(tables)
+        f, indent = self._open(name)
+        f.write('[')
+        for i, table in enumerate(tables):
+            f.write(',\n' if i else '\n')
+            f.write(textwrap.indent(json.dumps(table, indent='\t'), indent + '\t'))
+        f.write('\n' + indent + ']')
+        if f is not self._combined:
+            f.write('\n')
+            f.close()
+            os.replace(f.name, f.name[:-len('.tmp')])
+
+    def close(self, discard=False):
+        """Completes the combined file, or drops it if discard"""
+        if self._combined is None:
+            return
+        if not discard:
+            self._combined.write('\n}\n')
+        if self._combined is sys.stdout:
+            return
+        self._combined.close()
+        if discard:
+            os.remove(self.output + '.tmp')
+        else:
+            os.replace(self.output + '.tmp', self.output)
+
+
+def run_batch(opts):
+    inputs = []
+    failed = 0
+    for source in opts.batch or []:
+        found = expand_source(source)
+        if not found:
+            print('Nothing to abstract in {}'.format(source), file=sys.stderr)
+            failed += 1
+        inputs += found
+    for type_ in opts.gerrit or []:
+        if type_ == 'all':
+            inputs += [('gerrit', i) for i in type_to_path_mapping]
+        else:
+            inputs.append(('gerrit', type_))
+
+    names = {}
+    for kind, value in inputs:
+        name = value if kind == 'gerrit' else _input_name(value)
+        if kind == 'file':
+            value = os.path.normpath(value)
+        if names.setdefault(name, (kind, value)) != (kind, value):
+            raise Exception('Two inputs are called {}: {} and {}'.format(
+                name, names[name][1], value))
+    for database in opts.database or []:
+        if database in names:
+            raise Exception('Two inputs are called %s' % database)
+
+    writer = BatchWriter(opts.output_dir, opts.output)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(opts.jobs) as executor:
+            futures = {
+                executor.submit(abstract_input, input_): name
+                for name, input_ in names.items()}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                value = names[name][1]
+                try:
+                    tables = future.result()
+                except Exception as e:
+                    print('Could not abstract {}: {}'.format(value, e), file=sys.stderr)
+                    failed += 1
+                    continue
+                writer.write(name, tables)
+        # The databases are read one after the other, the server is what
+        # does the work there
+        for database in opts.database or []:
+            if opts.database_source == 'information-schema':
+                tables = abstract_database_information_schema(opts.sql_command, database)
+            else:
+                tables = abstract_database(opts.sql_command, database)
+            try:
+                writer.write(database, tables)
+            except Exception as e:
+                print('Could not abstract {}: {}'.format(database, e), file=sys.stderr)
+                failed += 1
+    except BaseException:
+        writer.close(discard=True)
+        raise
+    writer.close()
+    return failed
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sqlfile", help="sql file to process", metavar="FILE")
+    parser.add_option(
+        "--batch", action="append", metavar="SOURCE",
+        help="directory, glob, sql file or manifest of sql files to process, can be repeated")
+    parser.add_option(
+        "--gerrit", action="append", metavar="TYPE",
+        help="type from gerrit to process ({}, or all), can be repeated".format(
+            ', '.join(type_to_path_mapping)))
+    parser.add_option(
+        "--database", action="append", metavar="DB",
+        help="live database to abstract from SHOW CREATE TABLE, can be repeated")
+    parser.add_option(
+        "--sql-command", default="mysql",
+        help="command used to query --database, e.g. 'sudo mysql'")
+    parser.add_option(
+        "--database-source", default="show-create", choices=["show-create", "information-schema"],
+        help="read --database from SHOW CREATE TABLE or, like the drift checker, from "
+        "information_schema")
+    parser.add_option(
+        "--output-dir", metavar="DIR", help="write one NAME.json per input in DIR")
+    parser.add_option(
+        "--output", metavar="FILE",
+        help="write all inputs in one {name: schema} file instead of stdout")
+    parser.add_option(
+        "--jobs", type="int", default=os.cpu_count(), help="number of parser processes")
 
-    print(json.dumps(final_result, indent='\t'))
+    opts, args = parser.parse_args()
+
+    if opts.batch or opts.gerrit or opts.database:
+        sys.exit(1 if run_batch(opts) else 0)
+
+    # If --sqlfile is passed, parse that, else parse MW core from gerrit (old behaviour)
+    if opts.sqlfile:
+        sqlfile = open(opts.sqlfile,'r')
+        sql = sqlfile.read()
+    else:
+        sql = get_sql_from_gerrit('core')
+
+    print(json.dumps(abstract_schema(parse_sql(sql)), indent='\t'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,96 @@
 #!/usr/bin/python3
 
 import argparse
+import cProfile
+import hashlib
 import json
+import os
+import pstats
 import re
+import sys
 import time
+import tracemalloc
+import zlib
 from collections import defaultdict
 
-from checker import Checker, CheckerFactory
-from data_access.sql import get_table_structure_sql
-from data_access.wmf import Gerrit, get_wikis_from_dblist, get_shard_mapping
+from checkpoint import Checkpoint
+from checker import (CategoryRun, CheckerFactory, ComparisonCache,
+                     DriftRecorder, DriftStore)
+from comparison import ComparisonEngine
+from data_access.cache import configure_cache
+from data_access.sql import QueryError, get_backend
+from data_access.wmf import (Gerrit, get_dblist_path, get_shard_mapping,
+                             get_wikis_from_dblist)
 from domain.db import Db
-from domain.table import Column
+from domain.information_schema import diff_tables, table_from_rows
+from domain.table import Table, compile_schema
+from instrumentation import timings
+from sampling import FleetSample, drift_density
+from scheduler import ScanScheduler, spread_host_jobs
+
+
+def check_shards(category, shards):
+    """Makes sure the partial files of a category are every shard of the
+    same run, each of them once"""
+    counts = {int(shard.split('/')[1]) for shard in shards}
+    if len(counts) > 1:
+        raise Exception('Partial files of {} come from runs split in {} shards'.format(
+            category, ' and '.join(str(i) for i in sorted(counts))))
+    numbers = [int(shard.split('/')[0]) for shard in shards]
+    duplicates = sorted({i for i in numbers if numbers.count(i) > 1})
+    if duplicates:
+        raise Exception('Shards {} of {} are given more than once'.format(
+            ', '.join(str(i) for i in duplicates), category))
+    missing = sorted(set(range(1, counts.pop() + 1)) - set(numbers))
+    if missing:
+        raise Exception('Shards {} of {} are missing'.format(
+            ', '.join(str(i) for i in missing), category))
+
+
+def merge(argv):
+    merge_parser = argparse.ArgumentParser(
+        prog='db_drift_checker.py merge',
+        description='Combine the partial drift files of a sharded run')
+    merge_parser.add_argument(
+        'partials', nargs='+',
+        help='Partial drift files, like drifts_core.shard1of4.json')
+    merge_parser.add_argument(
+        '--columnar', action='store_true',
+        help='Also write the merged drifts in the compressed columnar format')
+    merge_args = merge_parser.parse_args(argv)
+    stores = {}
+    partials = defaultdict(int)
+    shards = defaultdict(list)
+    for path in merge_args.partials:
+        with open(path, 'r') as f:
+            drifts = json.loads(f.read())
+        category = drifts.get('_metadata', {}).get('category')
+        if category is None:
+            category = re.sub(
+                r'^drifts_(.+?)(\.shard\d+of\d+)?\.json$', r'\1', os.path.basename(path))
+        if category not in stores:
+            stores[category] = DriftStore(category, 0, columnar=merge_args.columnar)
+        stores[category].merge(drifts)
+        partials[category] += 1
+        if 'shard' in drifts.get('_metadata', {}):
+            shards[category].append(drifts['_metadata']['shard'])
+    for category, found in shards.items():
+        check_shards(category, found)
+    for category, store in stores.items():
+        store.metadata['shards'] = partials[category]
+        store.flush()
+        print('Wrote', store.path)
+
+
+if sys.argv[1:2] == ['merge']:
+    merge(sys.argv[2:])
+    sys.exit()
 
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument(
     'type',
-    help='Type of check, core, wikibase_client, etc.')
+    help='Type of check, core, wikibase_client, etc. Several can be given separated by commas, '
+    '"all" checks the main ones and "everything" all the ones in abstract_paths.json')
 parser.add_argument(
     'command',
     help='Command to get to sql, for production it should be something like "sql {wiki} -- " and "sudo mysql " for localhost')
@@ -44,6 +119,133 @@ parser.add_argument(
     '--gerrit-schema-file',
     help='Custom abstract schema file to read from, like `mediawiki/core/+/REL1_43/maintenance/tables.json`'
 )
+parser.add_argument(
+    '--flush-interval', type=int, default=300,
+    help='Seconds between intermediate writes of the drifts file, 0 to only write it at the end'
+)
+parser.add_argument(
+    '--columnar', action='store_true',
+    help='Also write the drifts to drifts_{type}.jsonl.gz, compressed and indexed by drift'
+)
+parser.add_argument(
+    '--jobs', type=int, default=1,
+    help='Number of hosts to query in parallel'
+)
+parser.add_argument(
+    '--section-jobs', type=int, default=0,
+    help='Maximum number of parallel queries per section, 0 for no limit'
+)
+parser.add_argument(
+    '--host-jobs', type=int, default=1,
+    help='Maximum number of parallel queries per host'
+)
+parser.add_argument(
+    '--bulk', action='store_true',
+    help='Query all wikis of a section on a host at once instead of one query per wiki'
+)
+parser.add_argument(
+    '--bulk-timeout', type=int, default=60,
+    help='Timeout in seconds of the query in bulk mode'
+)
+parser.add_argument(
+    '--schedule', default='wiki', choices=['wiki', 'host'],
+    help='Query every host of a wiki one wiki after the other, or give every host (or its '
+    '--host-jobs shares) a single job going through all of its wikis, spread over sections'
+)
+parser.add_argument(
+    '--pipeline', action='store_true',
+    help='With --schedule host, send the queries of all wikis of a host in a single session'
+)
+parser.add_argument(
+    '--backend', default='cli', choices=['cli', 'pymysql'],
+    help='How to talk to the databases, by running the sql command or directly with PyMySQL'
+)
+parser.add_argument(
+    '--mysql-config', default='~/.my.cnf',
+    help='Client config file with the credentials, only used by the pymysql backend'
+)
+parser.add_argument(
+    '--engine', default='batch', choices=['batch', 'table'],
+    help='Compare all tables of a host at once, computing the drifts once per distinct column, '
+    'or one table at a time'
+)
+parser.add_argument(
+    '--no-cache', action='store_true',
+    help='Compare every table even if an identical one has already been compared'
+)
+parser.add_argument(
+    '--cache-dir', default='~/.cache/db-analyzor-tools',
+    help='Where to keep downloaded schema files, dblists and db configs'
+)
+parser.add_argument(
+    '--cache-ttl', type=int, default=3600,
+    help='Seconds a downloaded file is used before checking if it changed'
+)
+parser.add_argument(
+    '--offline', action='store_true',
+    help='Only use already downloaded files, never hit the network'
+)
+parser.add_argument(
+    '--no-http-cache', action='store_true',
+    help='Download schema files, dblists and db configs on every run instead of keeping them '
+    'in --cache-dir'
+)
+parser.add_argument(
+    '--checkpoint',
+    help='Journal of the checked hosts, defaults to checkpoint_{type}.jsonl. Only written with '
+    'this option, --resume or --incremental'
+)
+parser.add_argument(
+    '--resume', action='store_true',
+    help='Continue an interrupted run from its checkpoint instead of starting over'
+)
+parser.add_argument(
+    '--incremental', action='store_true',
+    help='Only rescan wikis whose tables were created or altered since the last finished run'
+)
+parser.add_argument(
+    '--shard',
+    help='Only do part i of N of the run, like 2/4, to spread it over several workers. '
+    'Results need to be combined with the merge command. Needs --all'
+)
+parser.add_argument(
+    '--shard-by', default='job', choices=['job', 'section'],
+    help='Split the work by section or by (section, host, wiki)'
+)
+parser.add_argument(
+    '--retries', type=int, default=2,
+    help='How many times to retry a host that failed or timed out, at the end of the run'
+)
+parser.add_argument(
+    '--max-timeout', type=int, default=60,
+    help='Upper bound in seconds of the timeout given to slow hosts'
+)
+parser.add_argument(
+    '--sample', type=float,
+    help='Quick scan of a sample of the fleet: that many wikis per section, or that fraction of '
+    'them if below 1, spread over all hosts. Drifts go to drifts_{type}.sample.json'
+)
+parser.add_argument(
+    '--sample-weighted', action='store_true',
+    help='Pick wikis that had more drifts in the last full run (drifts_{type}.json) more often'
+)
+parser.add_argument(
+    '--sample-seed', type=int,
+    help='Seed of the sample, to get the same one again like when resuming'
+)
+parser.add_argument(
+    '--sample-min-share', type=float, default=0.9,
+    help='Drifts found on the whole sample are confirmed fleet-wide if the sample shows '
+    '(at 95%% confidence) they are on at least that share of it. Default: 0.9'
+)
+parser.add_argument(
+    '--profile', action='store_true',
+    help='Run under cProfile and tracemalloc, the profile is written to profile_{type}.prof'
+)
+parser.add_argument(
+    '--prometheus-file',
+    help='Also write the timings of the run to this file for the Prometheus textfile exporter'
+)
 
 args = parser.parse_args()
 
@@ -53,179 +255,346 @@ categories = [
 ]
 with open('abstract_paths.json', 'r') as f:
     schema_config = json.loads(f.read())
+if args.no_http_cache and args.offline:
+    raise Exception('--offline needs the http cache, it can not be used with --no-http-cache')
+configure_cache(args.cache_dir, args.cache_ttl, args.offline, not args.no_http_cache)
+worker_shard = None
+if args.shard:
+    worker_shard = tuple(int(i) for i in args.shard.split('/'))
+    if len(worker_shard) != 2 or not 1 <= worker_shard[0] <= worker_shard[1]:
+        raise Exception('--shard should look like i/N with 1 <= i <= N')
+    if not args.all:
+        # Otherwise every worker would check its own random wiki of s3
+        raise Exception('--shard only works with --all')
+if args.pipeline and args.schedule != 'host':
+    raise Exception('--pipeline only works with --schedule host')
+sample = None
+if args.sample is not None:
+    if not args.prod:
+        raise Exception('--sample only works with --prod')
+    if worker_shard is not None or args.incremental:
+        raise Exception('--sample can not be combined with --shard or --incremental')
+    if args.sample <= 0:
+        raise Exception('--sample should be a positive number of wikis or a fraction')
+    sample = FleetSample(
+        args.sample if args.sample < 1 else None,
+        int(args.sample) if args.sample >= 1 else None,
+        seed=args.sample_seed, min_share=args.sample_min_share)
+scheduler = ScanScheduler(
+    args.jobs, args.section_jobs, args.host_jobs, args.retries,
+    retry_on=(QueryError,))
+scheduler.latency.max_timeout = args.max_timeout
+backend = get_backend(args.backend, args.dc, args.skip_host, args.mysql_config)
+checkpoint = Checkpoint(
+    args.checkpoint or 'checkpoint_{}{}.jsonl'.format(
+        args.type.lower().replace(',', '_'),
+        '.shard{}of{}'.format(*worker_shard) if worker_shard else
+        '.sample' if sample is not None else ''),
+    args.resume,
+    args.incremental,
+    bool(args.checkpoint))
 
 
-def handle_column(expected: Column, column_type, nullable, checker: Checker):
-    actual_size = None
-    if '(' in column_type:
-        actual_size = column_type.split('(')[1].split(')')[0]
-        if ',' in actual_size:
-            actual_size = set(actual_size.replace(
-                '\'', '').replace('"', '').split(','))
-
-    if actual_size and expected.size_:
-        if not isinstance(expected.size_, set):
-            the_same = int(actual_size) == int(expected.size_)
-        else:
-            the_same = actual_size == expected.size_
-        checker.run_check('field-size-mismatch', not the_same)
-    unsigned_mismatch = \
-        (expected.unsigned and ' unsigned' not in column_type) or \
-        (expected.unsigned is False and ' unsigned' in column_type)
-    checker.run_check('field-unsigned-mismatch', unsigned_mismatch)
-    actual_type = column_type.split('(')[0].split(' ')[0]
-    actual_type = actual_type.replace(
-        'double precision', 'float').replace(
-        'double', 'float')
-    checker.run_check('field-type-mismatch', actual_type != expected.type_)
-    nullable_mismatch = \
-        (nullable == 'no' and expected.not_null is not True) or \
-        (nullable == 'yes' and expected.not_null is not False)
-    checker.run_check('field-nullable-mismatch', nullable_mismatch)
-
-
-def compare_table_with_prod(db, expected_table, actual_table):
-    if not actual_table:
-        print('no response')
-        return {}
-    table_sql = [i for i in actual_table if 'COLUMN_COMMENT' in i]
-    table_indexes = [i for i in actual_table if 'INDEX_NAME' in i]
-    if not table_sql or not table_indexes:
+def compare_table_with_prod(db, expected_table: Table, actual_table, store):
+    actual = table_from_rows(expected_table.name, actual_table or [])
+    if not actual.columns or not actual.indexes:
         print('no response')
         return {}
-    fields_in_prod = []
-    table_name = expected_table['name']
-    checker_factory = CheckerFactory(db, args.type, table_name)
-    for actual_column in table_sql:
-        fields_in_prod.append(actual_column['COLUMN_NAME'])
-        name = actual_column['COLUMN_NAME']
-        expected_column = None
-        for column in expected_table['columns']:
-            if column['name'] == name:
-                expected_column = column
-                break
-        else:
-            checker = checker_factory.get_checker(name)
-            checker.run_check('field-mismatch-prod-extra', True)
-            continue
+    checker_factory = CheckerFactory(db, store, expected_table.name)
+    for piece_name, drift_type in diff_tables(expected_table, actual):
+        checker_factory.get_checker(piece_name).run_check(drift_type, True)
 
-        expected = Column.newFromAbstractSchema(expected_column)
-        checker = checker_factory.get_checker(actual_column['COLUMN_NAME'])
-        handle_column(
-            expected,
-            actual_column['COLUMN_TYPE'],
-            actual_column['IS_NULLABLE'].lower(),
-            checker)
-
-        checker.run_check(
-            'field-auto-increment-mismatch',
-            ( 'auto_increment' in actual_column['EXTRA'] ) != expected.auto_increment
-        )
-
-    for column in expected_table['columns']:
-        checker = checker_factory.get_checker(actual_column['COLUMN_NAME'])
-        checker.run_check(
-            'field-mismatch-codebase-extra',
-            column['name'] not in fields_in_prod)
-
-    indexes = {}
-    for actual_index in table_indexes:
-        if actual_index['INDEX_NAME'] not in indexes:
-            indexes[actual_index['INDEX_NAME']] = {
-                'unique': actual_index['NON_UNIQUE'] == '0',
-                'columns': [actual_index['COLUMN_NAME']]
-            }
-        else:
-            indexes[actual_index['INDEX_NAME']]['columns'].append(
-                actual_index['COLUMN_NAME'])
-    expected_indexes = expected_table['indexes']
-    expected_pk = expected_table.get('pk')
-    for index in indexes:
-        checker = checker_factory.get_checker(index)
-        if index == 'PRIMARY':
-            checker.run_check(
-                'primary-key-mismatch',
-                indexes[index]['columns'] != expected_pk
-            )
-            continue
-        expected_index = None
-        for i in expected_indexes:
-            if i['name'] == index:
-                expected_index = i
-                break
+
+def group_by_table(rows):
+    data_ = defaultdict(list)
+    for def_ in rows:
+        if args.dbprefix:
+            # Only use tables that have the prefix, to avoid overwriting
+            # data with unrelated tables
+            if not def_['TABLE_NAME'].startswith(args.dbprefix):
+                continue
+            def_['TABLE_NAME'] = def_['TABLE_NAME'].removeprefix(args.dbprefix)
+        data_[def_['TABLE_NAME']].append(def_)
+    return data_
+
+
+def check_table(db, table: Table, actual_table, run: CategoryRun):
+    """Returns the drifts found on the table"""
+    if run.cache is None:
+        recorder = DriftRecorder()
+        compare_table_with_prod(db, table, actual_table, recorder)
+        return recorder.drifts
+    key = (table, run.cache.fingerprint(actual_table))
+    drifts = run.cache.get(key)
+    if drifts is None:
+        recorder = DriftRecorder()
+        compare_table_with_prod(db, table, actual_table, recorder)
+        drifts = run.cache.set(key, recorder.drifts)
+    return drifts
+
+
+def report_drifts(db, run: CategoryRun, drifts):
+    for drift in drifts:
+        run.store.add(drift, db.section, '%s:%s' % (db.host, db.wiki))
+
+
+def check_wikis(shard, host, runs, data_by_wiki):
+    """Checks the tables of the wikis of a host against all categories,
+    returns the drifts found per wiki and category"""
+    found = {wiki: {} for wiki in data_by_wiki}
+    for run in runs:
+        wikis = [wiki for wiki in data_by_wiki if run.applies_to(wiki)]
+        if run.engine is not None:
+            frame = run.engine.frame()
+            for wiki in wikis:
+                frame.add(wiki, data_by_wiki[wiki])
+            drifts_by_wiki = run.engine.compare(frame)
         else:
-            checker.run_check('index-mismatch-prod-extra', True)
-            continue
-        checker.run_check(
-            'index-uniqueness-mismatch',
-            indexes[index]['unique'] != expected_index['unique']
-        )
-        expected_columns = expected_index['columns']
-        checker.run_check(
-            'index-columns-mismatch',
-            indexes[index]['columns'] != expected_columns
-        )
-
-    for index in expected_indexes:
-        checker = checker_factory.get_checker(index['name'])
-        checker.run_check(
-            'index-mismatch-code-extra',
-            index['name'] not in indexes)
-
-
-def handle_wiki(shard, sql_data, hosts, wiki, sql_command):
+            drifts_by_wiki = {}
+            for wiki in wikis:
+                drifts = drifts_by_wiki[wiki] = []
+                for table in run.tables:
+                    if table.name == 'searchindex':
+                        continue
+                    if table.name not in data_by_wiki[wiki]:
+                        continue
+                    drifts += check_table(
+                        Db(shard, host, wiki), table, data_by_wiki[wiki][table.name], run)
+        for wiki in wikis:
+            drifts = drifts_by_wiki.get(wiki, [])
+            report_drifts(Db(shard, host, wiki), run, drifts)
+            found[wiki][run.name] = drifts
+    return found
+
+
+def check_tables(db, runs, data_):
+    """Checks the tables against all categories, returns the drifts found
+    per category"""
+    return check_wikis(db.section, db.host, runs, {db.wiki: data_})[db.wiki]
+
+
+def replay_unchanged(db, runs, version):
+    """Reports the drifts of the previous run if the schema didn't change"""
+    categories_ = [run.name for run in runs if run.applies_to(db.wiki)]
+    record = checkpoint.get_unchanged(db.host, db.wiki, version, categories_)
+    if record is None:
+        return False
+    for run in runs:
+        if run.name in categories_:
+            report_drifts(db, run, record['drifts'][run.name])
+    checkpoint.record(db.section, db.host, db.wiki, version, {
+        category: record['drifts'][category] for category in categories_})
+    return True
+
+
+def handle_host(shard, runs, host, wiki, sql_command):
+    db = Db(shard, host, wiki)
+    if checkpoint.is_done(host, wiki):
+        return
+    if args.wiki:
+        wiki = args.wiki
+    with timings.labels(shard, host):
+        version = None
+        if args.incremental:
+            with timings.measure('query'):
+                version = backend.get_schema_versions(host, sql_command, [wiki]).get(wiki)
+            if replay_unchanged(db, runs, version):
+                return
+        print(wiki, host)
+        with timings.measure('query'):
+            rows = scheduler.latency.measure(
+                host, 5, lambda timeout: backend.get_table_structure(
+                    host, sql_command, wiki, timeout))
+        with timings.measure('group'):
+            data_ = group_by_table(rows)
+        with timings.measure('compare'):
+            found = check_tables(db, runs, data_)
+        if rows:
+            checkpoint.record(shard, host, db.wiki, version, found)
+
+
+def handle_host_wikis(shard, runs, host, wikis):
+    """Checks the wikis of a host one after the other, in a single job"""
+    for wiki in wikis:
+        wiki_runs = [run for run in runs if run.applies_to(wiki)]
+        if wiki_runs:
+            handle_host(shard, wiki_runs, host, wiki, args.command.format(wiki=wiki))
+
+
+def handle_host_bulk(shard, runs, host, wikis, sql_command):
+    """Checks the wikis of a host with a single query, or with --pipeline
+    their own queries sent in a single session"""
+    wikis = [wiki for wiki in wikis if not checkpoint.is_done(host, wiki)]
+    if not wikis:
+        return
+    with timings.labels(shard, host):
+        versions = {}
+        if args.incremental:
+            with timings.measure('query'):
+                versions = backend.get_schema_versions(
+                    host, sql_command, wikis, args.bulk_timeout)
+            wikis = [
+                wiki for wiki in wikis
+                if not replay_unchanged(Db(shard, host, wiki), runs, versions.get(wiki))]
+            if not wikis:
+                return
+        print(shard, host, '({} wikis)'.format(len(wikis)))
+        # Bulk queries take longer the more wikis they cover
+        query = backend.get_tables_structure if args.bulk else backend.get_each_table_structure
+        with timings.measure('query'):
+            rows = scheduler.latency.measure(
+                (host, len(wikis)), args.bulk_timeout,
+                lambda timeout: query(host, sql_command, wikis, timeout))
+        with timings.measure('group'):
+            if args.bulk:
+                rows_by_wiki = defaultdict(list)
+                for def_ in rows:
+                    rows_by_wiki[def_['TABLE_SCHEMA']].append(def_)
+            else:
+                rows_by_wiki = rows
+            data_by_wiki = {
+                wiki: group_by_table(rows_by_wiki[wiki]) for wiki in wikis}
+        with timings.measure('compare'):
+            found = check_wikis(shard, host, runs, data_by_wiki)
+        for wiki in wikis:
+            if rows_by_wiki[wiki]:
+                checkpoint.record(shard, host, wiki, versions.get(wiki), found[wiki])
+
+
+def is_own_job(shard, host, wiki):
+    """Whether the job belongs to this worker when the run is sharded"""
+    if worker_shard is None:
+        return True
+    if args.shard_by == 'section':
+        key = str(shard)
+    else:
+        key = '{}:{}:{}'.format(shard, host, wiki)
+    return zlib.crc32(key.encode('utf-8')) % worker_shard[1] == worker_shard[0] - 1
+
+
+def handle_wiki(shard, runs, hosts, wiki, sql_command):
     if shard is not None:
         sql_command = sql_command.format(wiki=wiki)
     for host in hosts:
-        db = Db(shard, host, wiki)
-        if args.wiki:
-            wiki = args.wiki
-        print(wiki, host)
-        res = get_table_structure_sql(host, sql_command, wiki, args.dc, args.skip_host)
-        data_ = defaultdict(list)
-        for row in res.split('\n******'):
-            def_ = re.findall(
-                r'^\s*([A-Z_]+?)\s*: *(.*?) *$',
-                '\n'.join(
-                    row.split('\n')[
-                        1:]),
-                re.M)
-            if not def_:
-                continue
-            def_ = dict(def_)
-            if args.dbprefix:
-                # Only use tables that have the prefix, to avoid overwriting
-                # data with unrelated tables
-                if not def_['TABLE_NAME'].startswith(args.dbprefix):
-                    continue
-                def_['TABLE_NAME'] = def_['TABLE_NAME'].removeprefix(args.dbprefix)
-            data_[def_['TABLE_NAME']].append(def_)
-        for table in sql_data:
-            if table['name'] == 'searchindex':
-                continue
-            if table['name'] not in data_:
-                continue
-            compare_table_with_prod(db, table, data_[table['name']])
+        if not is_own_job(shard, host, wiki):
+            continue
+        scheduler.submit(
+            shard, host, handle_host, shard, runs, host, wiki, sql_command,
+            wiki=wiki)
+
+
+def submit_host_jobs(jobs, runs):
+    """Submits (section, host, wikis) jobs, as a single job per host (or
+    per --host-jobs share of its wikis) in bulk mode or with --schedule
+    host, else as one job per wiki"""
+    if args.schedule == 'host':
+        shares = max(1, args.host_jobs)
+        jobs = spread_host_jobs([
+            (shard, host, wikis[i::shares])
+            for shard, host, wikis in jobs for i in range(min(shares, len(wikis)))],
+            args.jobs)
+    for shard, host, wikis in jobs:
+        if args.bulk or (args.schedule == 'host' and args.pipeline):
+            # Any wiki of the section gets us to the right hosts
+            scheduler.submit(
+                shard, host, handle_host_bulk,
+                shard, runs, host, wikis, args.command.format(wiki=wikis[0]))
+        elif args.schedule == 'host':
+            scheduler.submit(shard, host, handle_host_wikis, shard, runs, host, wikis)
+        else:
+            for wiki in wikis:
+                wiki_runs = [run for run in runs if run.applies_to(wiki)]
+                if wiki_runs:
+                    scheduler.submit(
+                        shard, host, handle_host, shard, wiki_runs, host, wiki,
+                        args.command.format(wiki=wiki), wiki=wiki)
+
+
+def handle_wikis(wikis, runs, shard_mapping):
+    runs = [run for run in runs if any(run.applies_to(wiki) for wiki in wikis)]
+    if not runs:
+        return
+    if sample is not None:
+        handle_sample(wikis, runs, shard_mapping)
+        return
+    if args.prod and (args.bulk or args.schedule == 'host'):
+        wikis_by_shard = defaultdict(list)
+        for wiki in wikis:
+            wikis_by_shard[shard_mapping['wikis'][wiki]].append(wiki)
+        jobs = []
+        for shard, shard_wikis in wikis_by_shard.items():
+            for host in shard_mapping['hosts'][shard]:
+                host_wikis = [
+                    wiki for wiki in shard_wikis if is_own_job(shard, host, wiki)]
+                if host_wikis:
+                    jobs.append((shard, host, host_wikis))
+        submit_host_jobs(jobs, runs)
+        return
+    for wiki in wikis:
+        shard = shard_mapping['wikis'][wiki]
+        wiki_runs = [run for run in runs if run.applies_to(wiki)]
+        if wiki_runs:
+            handle_wiki(shard, wiki_runs, shard_mapping['hosts'][shard], wiki, args.command)
+
+
+def handle_sample(wikis, runs, shard_mapping):
+    wikis_by_shard = defaultdict(list)
+    for wiki in wikis:
+        wikis_by_shard[shard_mapping['wikis'][wiki]].append(wiki)
+    jobs = []
+    for shard, shard_wikis in wikis_by_shard.items():
+        wikis_by_host = defaultdict(list)
+        for host, wiki in sample.select(shard, shard_mapping['hosts'][shard], shard_wikis):
+            wikis_by_host[host].append(wiki)
+        jobs += [(shard, host, host_wikis) for host, host_wikis in wikis_by_host.items()]
+    submit_host_jobs(jobs, runs)
+
+
+def read_previous_drifts(category):
+    """Drifts file of the last full run of category, if there is one"""
+    try:
+        with open('drifts_{}.json'.format(category), 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def print_sample_report(category, report):
+    print('Sample of {}: {} (host, wiki) checked in {} sections'.format(
+        category, report['checked'], len(report['sections'])))
+    print('Confirmed fleet-wide, on at least {:.0%} of it ({}):'.format(
+        report['min_share'], len(report['confirmed'])))
+    for drift, found in sorted(report['confirmed'].items()):
+        print('  {} (at least {:.1%})'.format(drift, found['min_share']))
+    print('Need a full scan ({}):'.format(len(report['needs_full_scan'])))
+    for drift, found in sorted(
+            report['needs_full_scan'].items(), key=lambda i: (-i[1]['seen'], i[0])):
+        if found['min_share'] is not None:
+            print('  {} (seen on all {}, at least {:.1%})'.format(
+                drift, found['seen'], found['min_share']))
+        else:
+            print('  {} (seen on {} of {})'.format(drift, found['seen'], report['checked']))
+    if report['not_seen']:
+        print('Not seen since the last full run: {}'.format(len(report['not_seen'])))
 
 
-def handle_dblist(dblist, sql_data, shard_mapping, all_=False):
+def handle_dblist(dblist, runs, shard_mapping, all_=False):
     if dblist is not None:
         wikis = get_wikis_from_dblist(dblist, all_)
     else:
         wikis = ['']
-    for wiki in wikis:
-        shard = shard_mapping['wikis'][wiki]
-        handle_wiki(shard, sql_data, shard_mapping['hosts'][shard], wiki, args.command)
+    handle_wikis(wikis, runs, shard_mapping)
 
 
-def handle_category(category):
-    with open('drifts_{}.json'.format(category), 'w') as f:
-        f.write(json.dumps({
-            '_metadata': {
-                'time_start': time.time()
-            }
-        }))
+def drifts_path(category):
+    if sample is not None:
+        return 'drifts_{}.sample.json'.format(category)
+    if worker_shard is None:
+        return None
+    return 'drifts_{}.shard{}of{}.json'.format(category, *worker_shard)
 
+
+def load_category(category):
     if category in schema_config:
         if args.gerrit_schema_file:
             raise Exception("--gerrit-schema-file should only be used with the 'custom' type")
@@ -237,34 +606,135 @@ def handle_category(category):
         if not args.gerrit_schema_file:
             raise Exception("'custom' type requires --gerrit-schema-file to be provided")
         gerrit = Gerrit()
-        sql_data = json.loads(gerrit.get_file(args.gerrit_schema_file))    
+        sql_data = json.loads(gerrit.get_file(args.gerrit_schema_file))
     else:
         raise Exception("Unsupported type %s, consider using type 'custom' and --gerrit-schema-file" % category)
+    tables = compile_schema(sql_data)
+    schema_hash = hashlib.sha1(
+        json.dumps(sql_data, sort_keys=True).encode('utf-8')).hexdigest()
+    return CategoryRun(
+        category,
+        tables,
+        DriftStore(
+            category, args.flush_interval, drifts_path(category), args.columnar),
+        None if args.no_cache or args.engine == 'batch' else ComparisonCache(),
+        schema_config.get(category, {}).get('dblist'),
+        ComparisonEngine(tables, not args.no_cache) if args.engine == 'batch' else None,
+        schema_hash)
+
+
+def handle_categories(categories_):
+    """Checks all of the categories with a single pass over the hosts, so
+    every host and wiki is only queried once no matter how many categories
+    are checked."""
+    runs = [load_category(category) for category in categories_]
+    checkpoint.start(categories_, {run.name: run.schema_hash for run in runs})
+    runs_by_name = {run.name: run for run in runs}
+    for record in checkpoint.done_records():
+        db = Db(record['section'], record['host'], record['wiki'])
+        for category, drifts in record['drifts'].items():
+            report_drifts(db, runs_by_name[category], drifts)
+    for run in runs:
+        run.store.metadata['time_start'] = checkpoint.time_start
+        if worker_shard is not None:
+            run.store.metadata['category'] = run.name
+            run.store.metadata['shard'] = args.shard
+        run.store.flush()
+
+    previous = {}
+    if sample is not None:
+        previous = {run.name: read_previous_drifts(run.name) for run in runs}
+        if args.sample_weighted:
+            sample.density = defaultdict(int)
+            for data in previous.values():
+                for wiki, count in drift_density(data or {}).items():
+                    sample.density[wiki] += count
+
     if args.prod:
         shard_mapping = get_shard_mapping(args.dc)
-        if schema_config[category].get('dblist'):
-            handle_dblist(schema_config[category]['dblist'], sql_data, shard_mapping, args.all)
+        for run in runs:
+            if run.dblist:
+                run.wikis = set(get_wikis_from_dblist(run.dblist, True))
+        if all(run.dblist for run in runs):
+            dblists = list(dict.fromkeys(run.dblist for run in runs))
         else:
-            for shard in shard_mapping['hosts']:
-                handle_dblist(shard, sql_data, shard_mapping, args.all)
+            dblists = list(shard_mapping['hosts'])
+        wikis = []
+        for dblist in dblists:
+            wikis += get_wikis_from_dblist(dblist, args.all or sample is not None)
+        # Categories limited to a dblist always get all of its wikis, even
+        # when the sections they are in are cut down without --all
+        for run in runs:
+            if run.wikis:
+                wikis += sorted(run.wikis)
+        handle_wikis(list(dict.fromkeys(wikis)), runs, shard_mapping)
     else:
         # supporting localhost is fun
-        handle_dblist(None, sql_data, {'hosts': {'': ['localhost']}, 'wikis': {'': ''}})
+        handle_dblist(None, runs, {'hosts': {'': ['localhost']}, 'wikis': {'': ''}})
+    scheduler.wait()
+
+    for run in runs:
+        run.store.metadata['time_end'] = time.time()
+        if run.cache is not None:
+            run.store.metadata['comparison_cache'] = run.cache.stats()
+        if run.engine is not None:
+            run.store.metadata['comparison_engine'] = run.engine.stats()
+            if worker_shard is not None:
+                # Distinct values are shared by the shards, merge needs them
+                run.store.metadata['comparison_engine']['digests'] = run.engine.digests()
+        run.store.metadata['checkpoint'] = checkpoint.stats()
+        run.store.metadata['timings'] = timings.summary()
+        if tracemalloc.is_tracing():
+            run.store.metadata['memory_peak'] = tracemalloc.get_traced_memory()[1]
+        run.store.metadata['unreachable'] = [
+            failure for failure in scheduler.failures
+            if failure['wiki'] is None or run.applies_to(failure['wiki'])]
+        if sample is not None:
+            run.store.metadata['sample'] = sample.report(
+                run, run.store.metadata['unreachable'], previous.get(run.name))
+            print_sample_report(run.name, run.store.metadata['sample'])
+        run.store.flush()
+    checkpoint.finish()
 
-    with open('drifts_{}.json'.format(category), 'r') as f:
-        drifts = json.loads(f.read())
-    drifts['_metadata']['time_end'] = time.time()
-    with open('drifts_{}.json'.format(category), 'w') as f:
-        f.write(json.dumps(drifts, indent=4, sort_keys=True))
+
+def prefetch(categories_):
+    """Downloads schema files and dblists of all categories at once"""
+    paths = []
+    for category in categories_:
+        if category == 'custom' and args.gerrit_schema_file:
+            paths.append(args.gerrit_schema_file)
+        if category not in schema_config:
+            continue
+        paths += schema_config[category]['path']
+        if args.prod and schema_config[category].get('dblist'):
+            paths.append(get_dblist_path(schema_config[category]['dblist']))
+    Gerrit().prefetch_files(paths)
 
 
 def main():
     category = args.type.lower()
     if category == 'all':
-        for cat in categories:
-            handle_category(cat)
+        categories_ = categories
+    elif category == 'everything':
+        categories_ = list(schema_config)
     else:
-        handle_category(category)
+        categories_ = [i.strip() for i in category.split(',') if i.strip()]
+    prefetch(categories_)
+    handle_categories(categories_)
+    scheduler.shutdown()
+    backend.close()
+    if args.prometheus_file:
+        timings.write_prometheus(args.prometheus_file)
 
 
-main()
+if args.profile:
+    # Only the main thread is profiled, use --jobs 1 to see the whole run
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.runcall(main)
+    profile_path = 'profile_{}.prof'.format(args.type.lower().replace(',', '_'))
+    profiler.dump_stats(profile_path)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    print('Profile written to', profile_path)
+else:
+    main()
@@ -0,0 +1,213 @@
+"""Tables as found in production, from their information_schema rows.
+
+The rows of a table (COLUMNS and STATISTICS, with the string values the
+mysql client prints) are normalized either into a Table, to be diffed with
+the expected one, or into the abstract schema format, to produce a
+tables.json from a live database. Across a fleet there are only a few
+hundred distinct COLUMN_TYPE strings, so each one is parsed once.
+"""
+import functools
+
+from domain.table import Column, Index, Table
+
+_blob_lengths = {
+    'tinyblob': 255,
+    'blob': 65535,
+    'mediumblob': 16777215,
+    'longblob': 4294967295,
+}
+_text_lengths = {
+    'tinytext': 255,
+    'text': 65535,
+    'mediumtext': 16777215,
+    'longtext': 4294967295,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def parse_column_type(column_type):
+    """Type, size and unsignedness of a COLUMN_TYPE like 'int(10) unsigned'.
+    The size is the string in parentheses, or the set of values of an enum,
+    None if there is none."""
+    size_ = None
+    if '(' in column_type:
+        size_ = column_type.split('(')[1].split(')')[0]
+        if ',' in size_:
+            size_ = frozenset(size_.replace('\'', '').replace('"', '').split(','))
+    type_ = column_type.split('(')[0].split(' ')[0].replace('double', 'float')
+    return type_, size_, ' unsigned' in column_type
+
+
+def column_from_row(column_type, nullable, extra):
+    """Column of a COLUMNS row, not_null being None if IS_NULLABLE is
+    neither yes nor no"""
+    type_, size_, unsigned = parse_column_type(column_type)
+    not_null = {'no': True, 'yes': False}.get(nullable.lower())
+    return Column(type_, size_, not_null, unsigned, 'auto_increment' in extra)
+
+
+def build_table(name, columns, indexes):
+    """Table of (name, Column) and (index name, NON_UNIQUE, column name)
+    pairs, the primary key also showing up in the indexes, where it was
+    found, unlike in the expected tables"""
+    indexes_ = {}
+    for index_name, non_unique, column_name in indexes:
+        index = indexes_.get(index_name)
+        if index is None:
+            index = indexes_[index_name] = Index(index_name, non_unique == '0', [])
+        index.columns.append(column_name)
+    primary = indexes_.get('PRIMARY')
+    return Table(
+        name, dict(columns), indexes_, primary.columns if primary else None)
+
+
+def table_from_rows(name, rows):
+    """Table of the COLUMNS and STATISTICS rows of a table"""
+    return build_table(
+        name,
+        [(row['COLUMN_NAME'], column_from_row(
+            row['COLUMN_TYPE'], row['IS_NULLABLE'], row['EXTRA']))
+         for row in rows if 'COLUMN_COMMENT' in row],
+        [(row['INDEX_NAME'], row['NON_UNIQUE'], row['COLUMN_NAME'])
+         for row in rows if 'INDEX_NAME' in row])
+
+
+def diff_columns(expected: Column, actual: Column):
+    """Drift types of a column of a table_from_rows() Table"""
+    drift_types = []
+    if actual.size_ and expected.size_:
+        if not isinstance(expected.size_, set):
+            the_same = int(actual.size_) == int(expected.size_)
+        else:
+            the_same = actual.size_ == expected.size_
+        if not the_same:
+            drift_types.append('field-size-mismatch')
+    unsigned_mismatch = \
+        (expected.unsigned and not actual.unsigned) or \
+        (expected.unsigned is False and actual.unsigned)
+    if unsigned_mismatch:
+        drift_types.append('field-unsigned-mismatch')
+    if actual.type_ != expected.type_:
+        drift_types.append('field-type-mismatch')
+    nullable_mismatch = \
+        (actual.not_null is True and expected.not_null is not True) or \
+        (actual.not_null is False and expected.not_null is not False)
+    if nullable_mismatch:
+        drift_types.append('field-nullable-mismatch')
+    if actual.auto_increment != expected.auto_increment:
+        drift_types.append('field-auto-increment-mismatch')
+    return drift_types
+
+
+def diff_tables(expected: Table, actual: Table):
+    """(piece name, drift type) of every difference between an expected
+    table and a table_from_rows() one, which has to have columns"""
+    drifts = []
+    for name, column in actual.columns.items():
+        expected_column = expected.columns.get(name)
+        if expected_column is None:
+            drifts.append((name, 'field-mismatch-prod-extra'))
+            continue
+        drifts += [(name, i) for i in diff_columns(expected_column, column)]
+    # Missing columns are reported under the last column found
+    last_column = next(reversed(actual.columns))
+    for name in expected.columns:
+        if name not in actual.columns:
+            drifts.append((last_column, 'field-mismatch-codebase-extra'))
+
+    for name, index in actual.indexes.items():
+        if name == 'PRIMARY':
+            if index.columns != expected.pk:
+                drifts.append((name, 'primary-key-mismatch'))
+            continue
+        expected_index = expected.indexes.get(name)
+        if expected_index is None:
+            drifts.append((name, 'index-mismatch-prod-extra'))
+            continue
+        if index.unique != expected_index.unique:
+            drifts.append((name, 'index-uniqueness-mismatch'))
+        if index.columns != expected_index.columns:
+            drifts.append((name, 'index-columns-mismatch'))
+    for name in expected.indexes:
+        if name not in actual.indexes:
+            drifts.append((name, 'index-mismatch-code-extra'))
+    return drifts
+
+
+@functools.lru_cache(maxsize=None)
+def _abstract_type(column_type):
+    type_, size_, unsigned = parse_column_type(column_type)
+    options = {}
+    if unsigned:
+        options['unsigned'] = True
+    length = int(size_) if isinstance(size_, str) and size_.isdigit() else None
+    if type_ == 'int':
+        type_ = 'integer'
+    elif type_ == 'tinyint':
+        type_ = 'mwtinyint'
+    elif type_ in ('varbinary', 'binary'):
+        if type_ == 'binary':
+            options['fixed'] = True
+        type_ = 'binary'
+        options['length'] = length
+    elif type_ in _blob_lengths:
+        options['length'] = _blob_lengths[type_]
+        type_ = 'blob'
+    elif type_ in _text_lengths:
+        options['length'] = _text_lengths[type_]
+        type_ = 'text'
+    elif type_ == 'enum':
+        type_ = 'mwenum'
+        values = column_type.split('(', 1)[1].rsplit(')', 1)[0]
+        options['CustomSchemaOptions'] = {'enum_values': [
+            i.strip().strip('\'"') for i in values.split(',')]}
+    elif type_ == 'timestamp':
+        type_ = 'datetimetz'
+    elif type_ == 'decimal' and isinstance(size_, frozenset):
+        precision, _, scale = column_type.split('(')[1].split(')')[0].partition(',')
+        options['precision'] = int(precision)
+        options['scale'] = int(scale)
+    elif length is not None and not type_.endswith('int'):
+        # Display widths of integers are not part of the schema
+        options['length'] = length
+    return type_, options
+
+
+def abstract_column(row):
+    """Abstract schema of a COLUMNS row, as Column.newFromAbstractSchema()
+    reads it"""
+    type_, options = _abstract_type(row['COLUMN_TYPE'])
+    options = dict(options)
+    name = row['COLUMN_NAME']
+    if type_ == 'binary' and options.get('length') == 14 and 'timestamp' in name:
+        type_ = 'mwtimestamp'
+        del options['length']
+        if not options.pop('fixed', False):
+            options['CustomSchemaOptions'] = {'allowInfinite': True}
+    options['notnull'] = row['IS_NULLABLE'].lower() == 'no'
+    if 'auto_increment' in row['EXTRA']:
+        options['autoincrement'] = True
+    default = row.get('COLUMN_DEFAULT')
+    if default is not None and default != 'NULL':
+        # MariaDB quotes string defaults, MySQL doesn't
+        if len(default) > 1 and default[0] == default[-1] == '\'':
+            default = default[1:-1]
+        elif default.lstrip('-').isdigit():
+            default = int(default)
+        options['default'] = default
+    return {'name': name, 'type': type_, 'options': options}
+
+
+def abstract_table(name, rows):
+    """Abstract schema of the COLUMNS and STATISTICS rows of a table"""
+    table = table_from_rows(name, rows)
+    abstract = {
+        'name': name,
+        'columns': [abstract_column(row) for row in rows if 'COLUMN_COMMENT' in row],
+        'indexes': [
+            {'name': index.name, 'columns': index.columns, 'unique': index.unique}
+            for index in table.indexes.values() if index.name != 'PRIMARY'],
+    }
+    if table.pk:
+        abstract['pk'] = table.pk
+    return abstract
@@ -1,4 +1,6 @@
 class Column():
+    __slots__ = ('type_', 'size_', 'not_null', 'unsigned', 'auto_increment')
+
     def __init__(self, type_, size_, not_null, unsigned, auto_increment):
         self.type_ = type_
         self.size_ = size_
@@ -16,6 +18,7 @@ class Column():
                 'fixed'):
             type_ = 'varbinary'
         elif type_ in ('blob', 'text'):
+            # Tables use the binary charset, text columns show up as blobs
             if size_ < 256:
                 type_ = 'tinyblob'
             elif size_ < 65536:
@@ -40,7 +43,7 @@ class Column():
             else:
                 type_ = 'binary'
             size_ = 14
-        elif type_ in ('datetimetz'):
+        elif type_ == 'datetimetz':
             type_ = 'timestamp'
         not_null = schema['options'].get('notnull', False)
         unsigned = schema['options'].get('unsigned', False)
@@ -48,3 +51,44 @@ class Column():
             'autoincrement', False)
 
         return cls(type_, size_, not_null, unsigned, auto_increment)
+
+
+class Index():
+    __slots__ = ('name', 'unique', 'columns')
+
+    def __init__(self, name, unique, columns):
+        self.name = name
+        self.unique = unique
+        self.columns = columns
+
+    @classmethod
+    def newFromAbstractSchema(cls, schema):
+        return cls(schema['name'], schema['unique'], schema['columns'])
+
+
+class Table():
+    """Expected structure of a table, built once from its abstract schema
+    so that checking a host only takes dict lookups."""
+    __slots__ = ('name', 'columns', 'indexes', 'pk')
+
+    def __init__(self, name, columns, indexes, pk):
+        self.name = name
+        self.columns = columns
+        self.indexes = indexes
+        self.pk = pk
+
+    @classmethod
+    def newFromAbstractSchema(cls, schema):
+        columns = {}
+        for column in schema['columns']:
+            if column['name'] not in columns:
+                columns[column['name']] = Column.newFromAbstractSchema(column)
+        indexes = {}
+        for index in schema.get('indexes', []):
+            if index['name'] not in indexes:
+                indexes[index['name']] = Index.newFromAbstractSchema(index)
+        return cls(schema['name'], columns, indexes, schema.get('pk'))
+
+
+def compile_schema(sql_data):
+    return [Table.newFromAbstractSchema(table) for table in sql_data]
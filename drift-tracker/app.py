@@ -1,7 +1,10 @@
+import os
 import time
 
-from drift_tracker.report import get_report
-from flask import Flask, redirect, render_template, request
+from drift_tracker.history import DriftHistory
+from drift_tracker.refresher import ReportCache
+from drift_tracker.report import titles
+from flask import Flask, jsonify, redirect, render_template, request
 
 app = Flask(__name__)
 
@@ -15,6 +18,12 @@ valid_categories = [
     'globalblocking',
     'globalblocking_central',
 ]
+history = DriftHistory(
+    os.environ.get('DRIFT_TRACKER_HISTORY', 'drift_history.sqlite'))
+reports = ReportCache(
+    valid_categories,
+    int(os.environ.get('DRIFT_TRACKER_REFRESH_INTERVAL', 300)),
+    history)
 
 
 @app.route("/")
@@ -29,26 +38,82 @@ def hello():
 def report(category):
     if category not in valid_categories:
         return render_template('page_not_found.html'), 404
-    res = get_report(category, request.args.get('untrackedOnly', False))
-    report_ = res['report']
-    start_time = res['metadata'].get('time_start')
-    end_time = res['metadata'].get('time_end')
-    duration = None
-    if start_time and end_time:
-        duration = int(end_time) - int(start_time)
-        duration = "{:04.2f}".format(duration/3600)
-    if end_time:
-        end_time = time.strftime('%d %b %Y %H:%M:%S', time.gmtime(end_time))
-    if start_time:
-        start_time = time.strftime('%d %b %Y %H:%M:%S', time.gmtime(start_time))
-    stats = {
-        'total': len(report_),
-        'widespread': len([i for i in report_ if i['section_count'] > 5]),
-        'untracked': len([i for i in report_ if not i['tracked']]),
-        'untracked_widespread': len([i for i in report_ if i['section_count'] > 5 and not i['tracked']]),
-    }
+    res = reports.get(category, request.args.get('untrackedOnly', False))
     return render_template(
-        'report.html', report=report_, stats=stats, duration=duration, start_time=start_time, end_time=end_time)
+        'report.html', category=category, report=res['report'],
+        stats=res['stats'], **res['run'])
+
+
+@app.route("/api/report/<category>")
+def api_report(category):
+    """Summaries of the drifts of a category, paginated, sorted and
+    filtered by table, type, section and tracked (1 or 0)"""
+    if category not in valid_categories:
+        return jsonify({'error': 'Unknown category'}), 404
+    index = reports.get(category)['index']
+    sort = request.args.get('sort', 'section_count')
+    order = request.args.get('order', 'desc')
+    try:
+        page = int(request.args.get('page', 1))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'page and limit should be numbers'}), 400
+    valid = sort in index.sorts and order in ('asc', 'desc') and \
+        page >= 1 and 1 <= limit <= 500
+    if not valid:
+        return jsonify({'error': 'Invalid sort, order, page or limit'}), 400
+    filters = {
+        name: request.args[name]
+        for name in index.filters if name in request.args}
+    return jsonify(index.query(filters, sort, order == 'desc', page, limit))
+
+
+@app.route("/api/report/<category>/hosts")
+def api_report_hosts(category):
+    """Section, host and db of every occurrence of the drift given by code"""
+    if category not in valid_categories:
+        return jsonify({'error': 'Unknown category'}), 404
+    host_tables = reports.get(category)['index'].host_tables
+    table = host_tables.get(request.args.get('code'))
+    if table is None:
+        return jsonify({'error': 'Unknown drift'}), 404
+    return jsonify({'code': request.args['code'], 'hosts': table})
+
+
+def drift_title(name):
+    drift_parts = name.replace('  ', ' ').split(' ')
+    return titles.get(drift_parts[-1], name).format(
+        drift_parts[0], drift_parts[1])
+
+
+def format_time(timestamp):
+    return time.strftime('%d %b %Y %H:%M:%S', time.gmtime(timestamp))
+
+
+@app.route("/history/<category>")
+@app.route("/history/<category>/")
+def history_report(category):
+    if category not in valid_categories:
+        return render_template('page_not_found.html'), 404
+    # Makes sure the latest drifts file made it into the history
+    reports.get(category)
+    try:
+        days = float(request.args.get('days', 7))
+    except ValueError:
+        days = 7
+    section = request.args.get('section') or None
+    since = history.run_before(category, time.time() - days * 86400)
+    runs = history.runs(category)
+    diff = None
+    if since is not None:
+        diff = history.diff(category, since['id'], runs[-1]['id'], section)
+        for rows in diff.values():
+            for row in rows:
+                row['name'] = drift_title(row['drift'])
+    return render_template(
+        'history.html', category=category, days=days, section=section,
+        diff=diff, since=since and format_time(since['time']),
+        until=runs and format_time(runs[-1]['time']), runs=len(runs))
 
 
 @app.route("/set-tracking", methods=['GET'])
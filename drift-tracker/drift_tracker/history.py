@@ -0,0 +1,233 @@
+"""History of the drifts of every category across runs, in SQLite.
+
+Instead of a copy of every run, each occurrence of a drift (drift, section,
+host and wiki) is stored once with the first and last run it was seen in,
+the last run staying NULL while it is still there. Ingesting a run only
+closes the occurrences that are gone and inserts the new ones, so both the
+database and the ingestion grow with the changes between runs rather than
+with their size, and "what is present at run X" is a range lookup.
+
+Backfilling from old drift files, oldest first:
+    python3 -m drift_tracker.history drift_history.sqlite core \
+        drifts_core.*.json
+"""
+import argparse
+import json
+import sqlite3
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    time REAL NOT NULL,
+    metadata TEXT NOT NULL,
+    UNIQUE (category, time)
+);
+CREATE TABLE IF NOT EXISTS drifts (
+    id INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (category, name)
+);
+CREATE TABLE IF NOT EXISTS occurrences (
+    id INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    drift INTEGER NOT NULL REFERENCES drifts (id),
+    section TEXT NOT NULL,
+    host TEXT NOT NULL,
+    wiki TEXT NOT NULL,
+    first_run INTEGER NOT NULL REFERENCES runs (id),
+    last_run INTEGER REFERENCES runs (id)
+);
+CREATE INDEX IF NOT EXISTS occurrences_last_run
+    ON occurrences (category, last_run);
+CREATE INDEX IF NOT EXISTS occurrences_first_run
+    ON occurrences (category, first_run);
+CREATE INDEX IF NOT EXISTS occurrences_section
+    ON occurrences (category, section, last_run);
+'''
+
+
+class DriftHistory(object):
+    def __init__(self, path):
+        self.path = path
+        connection = self._connect()
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # One connection per call, the web app reads from several threads
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    @staticmethod
+    def run_time(data):
+        metadata = data.get('_metadata', {})
+        return (
+            metadata.get('time_end') or metadata.get('time_start') or
+            time.time())
+
+    def ingest(self, category, data, run_time=None):
+        """Adds the content of a drifts file as the latest run of category.
+        Returns the id of the run, or None if it was already ingested."""
+        run_time = run_time or self.run_time(data)
+        connection = self._connect()
+        try:
+            with connection:
+                latest = connection.execute(
+                    'SELECT id, time FROM runs WHERE category = ? '
+                    'ORDER BY time DESC LIMIT 1', (category,)).fetchone()
+                if latest is not None and run_time <= latest['time']:
+                    if connection.execute(
+                            'SELECT 1 FROM runs '
+                            'WHERE category = ? AND time = ?',
+                            (category, run_time)).fetchone():
+                        return None
+                    raise Exception(
+                        'Runs of %s have to be ingested oldest first' %
+                        category)
+                run_id = connection.execute(
+                    'INSERT INTO runs (category, time, metadata) '
+                    'VALUES (?, ?, ?)',
+                    (category, run_time,
+                     json.dumps(data.get('_metadata', {})))).lastrowid
+                self._ingest_occurrences(
+                    connection, category, data, run_id,
+                    None if latest is None else latest['id'])
+        finally:
+            connection.close()
+        return run_id
+
+    def _ingest_occurrences(
+            self, connection, category, data, run_id, previous_run):
+        drift_ids = self._drift_ids(connection, category)
+        new_drifts = [
+            (category, name) for name in data
+            if not name.startswith('_') and name not in drift_ids]
+        connection.executemany(
+            'INSERT INTO drifts (category, name) VALUES (?, ?)', new_drifts)
+        if new_drifts:
+            drift_ids = self._drift_ids(connection, category)
+
+        current = set()
+        for name, sections in data.items():
+            if name.startswith('_'):
+                continue
+            for section, entries in sections.items():
+                for entry in entries:
+                    host, _, wiki = entry.rpartition(':')
+                    current.add((drift_ids[name], section, host, wiki))
+
+        open_ = {}
+        if previous_run is not None:
+            for row in connection.execute(
+                    'SELECT id, drift, section, host, wiki FROM occurrences '
+                    'WHERE category = ? AND last_run IS NULL', (category,)):
+                key = (row['drift'], row['section'], row['host'], row['wiki'])
+                open_[key] = row['id']
+            connection.executemany(
+                'UPDATE occurrences SET last_run = ? WHERE id = ?',
+                [(previous_run, id_)
+                 for key, id_ in open_.items() if key not in current])
+        connection.executemany(
+            'INSERT INTO occurrences '
+            '(category, drift, section, host, wiki, first_run, last_run) '
+            'VALUES (?, ?, ?, ?, ?, ?, NULL)',
+            [(category,) + key + (run_id,)
+             for key in current if key not in open_])
+
+    @staticmethod
+    def _drift_ids(connection, category):
+        return dict(connection.execute(
+            'SELECT name, id FROM drifts WHERE category = ?',
+            (category,)).fetchall())
+
+    def runs(self, category):
+        connection = self._connect()
+        try:
+            return [
+                {'id': row['id'], 'time': row['time']}
+                for row in connection.execute(
+                    'SELECT id, time FROM runs WHERE category = ? '
+                    'ORDER BY time', (category,))]
+        finally:
+            connection.close()
+
+    def run_before(self, category, timestamp):
+        """Latest run at or before timestamp, or the first run if there is
+        none that old"""
+        runs = self.runs(category)
+        older = [run for run in runs if run['time'] <= timestamp]
+        if older:
+            return older[-1]
+        return runs[0] if runs else None
+
+    def diff(self, category, since_run, until_run=None, section=None):
+        """Drifts (per section) new, resolved and persistent between two
+        runs, with the number of host:wiki entries they have"""
+        if until_run is None:
+            until_run = self.runs(category)[-1]['id']
+        present = (
+            'SELECT drift, section, COUNT(*) AS entries FROM occurrences '
+            'WHERE category = :category AND first_run <= {0} '
+            'AND (last_run IS NULL OR last_run >= {0}) '
+            '{1} GROUP BY drift, section')
+        section_filter = \
+            'AND section = :section' if section is not None else ''
+        params = {
+            'category': category, 'section': section,
+            'since': since_run, 'until': until_run}
+        connection = self._connect()
+        try:
+            before = {
+                (row['drift'], row['section']): row['entries']
+                for row in connection.execute(
+                    present.format(':since', section_filter), params)}
+            after = {
+                (row['drift'], row['section']): row['entries']
+                for row in connection.execute(
+                    present.format(':until', section_filter), params)}
+            names = dict(connection.execute(
+                'SELECT id, name FROM drifts WHERE category = ?',
+                (category,)).fetchall())
+        finally:
+            connection.close()
+
+        def rows(keys, counts):
+            return sorted(
+                ({'drift': names[drift], 'section': section_,
+                  'entries': counts[(drift, section_)]}
+                 for drift, section_ in keys),
+                key=lambda i: (-i['entries'], i['drift'], i['section']))
+        return {
+            'new': rows(after.keys() - before.keys(), after),
+            'resolved': rows(before.keys() - after.keys(), before),
+            'persistent': rows(after.keys() & before.keys(), after),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ingest drift files into the history')
+    parser.add_argument('database')
+    parser.add_argument('category')
+    parser.add_argument('files', nargs='+', help='Drift files, oldest first')
+    args = parser.parse_args()
+    history = DriftHistory(args.database)
+    for path in args.files:
+        with open(path, 'r') as f:
+            data = json.loads(f.read())
+        run_id = history.ingest(args.category, data)
+        if run_id is None:
+            print(path, 'already ingested')
+        else:
+            print(path, 'ingested as run {}'.format(run_id))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+
+def _make_session():
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Shared by all requests the app serves, to keep connections alive
+session = _make_session()
+
+
+def get(url, headers=None, timeout=DEFAULT_TIMEOUT):
+    return session.get(url, headers=headers, timeout=timeout)
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import threading
+import traceback
+
+from . import http_client
+from .report import (ReportIndex, build_report, build_stats, describe_run,
+                     get_drifts_url)
+from .tracking import TRACKING_URL
+
+
+class ConditionalSource(object):
+    """Remote JSON file polled with conditional requests, so an unchanged
+    file is neither downloaded nor parsed again. `version` goes up every
+    time the content actually changes."""
+
+    def __init__(self, url):
+        self.url = url
+        self.data = None
+        self.version = 0
+        self._etag = None
+        self._last_modified = None
+        self._digest = None
+
+    def poll(self):
+        headers = {}
+        if self.data is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        res = http_client.get(self.url, headers=headers)
+        if res.status_code == 304 and self.data is not None:
+            return
+        res.raise_for_status()
+        self._etag = res.headers.get('ETag')
+        self._last_modified = res.headers.get('Last-Modified')
+        # Not every server sends validators
+        digest = hashlib.sha1(res.content).hexdigest()
+        if digest == self._digest:
+            return
+        self.data = json.loads(res.text)
+        self._digest = digest
+        self.version += 1
+
+
+class ReportCache(object):
+    """Reports of all categories, with their stats, kept in memory.
+
+    A background thread polls the drift files and the tracking data every
+    `interval` seconds and rebuilds the reports of a category only when one
+    of them changed, so requests never wait on the network or on building
+    the report, except for the very first one of a category.
+    Every new drifts file also goes into `history` if one is given.
+    """
+
+    def __init__(self, categories, interval=300, history=None):
+        self.categories = categories
+        self.interval = interval
+        self.history = history
+        self._tracking = ConditionalSource(TRACKING_URL)
+        self._drifts = {
+            category: ConditionalSource(get_drifts_url(category))
+            for category in categories}
+        # (category, untracked_only) -> report, its index, stats and run times
+        self._reports = {}
+        # category -> versions of the sources its reports were built from
+        self._built = {}
+        # category -> version of its drifts file last put in the history
+        self._ingested = {}
+        self._lock = threading.Lock()
+        # So that a request refreshing a category doesn't wait for the
+        # background refresh of all the others
+        self._tracking_lock = threading.Lock()
+        self._category_locks = {
+            category: threading.Lock() for category in categories}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _poll(source):
+        try:
+            source.poll()
+        except Exception:
+            # Keep serving what we have
+            traceback.print_exc()
+
+    @staticmethod
+    def _build(data, tracked, untracked_only):
+        report = build_report(data, tracked, untracked_only)
+        return {
+            'report': report['report'],
+            'index': ReportIndex(report['report']),
+            'stats': build_stats(report['report']),
+            'metadata': report['metadata'],
+            'run': describe_run(report['metadata']),
+        }
+
+    def _ingest(self, category, source):
+        if self.history is None:
+            return
+        if self._ingested.get(category) == source.version:
+            return
+        try:
+            self.history.ingest(category, source.data)
+        except Exception:
+            traceback.print_exc()
+        self._ingested[category] = source.version
+
+    def refresh(self, categories=None):
+        with self._tracking_lock:
+            self._poll(self._tracking)
+            tracked = self._tracking.data or {}
+            tracking_version = self._tracking.version
+        for category in categories or self.categories:
+            with self._category_locks[category]:
+                self._refresh_category(category, tracked, tracking_version)
+
+    def _refresh_category(self, category, tracked, tracking_version):
+        source = self._drifts[category]
+        self._poll(source)
+        if source.data is None:
+            return
+        self._ingest(category, source)
+        versions = (source.version, tracking_version)
+        if self._built.get(category) == versions:
+            return
+        built = {
+            (category, untracked_only): self._build(
+                source.data, tracked, untracked_only)
+            for untracked_only in (False, True)}
+        with self._lock:
+            self._reports.update(built)
+        self._built[category] = versions
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                traceback.print_exc()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='report-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self, category, untracked_only=False):
+        self.start()
+        key = (category, bool(untracked_only))
+        with self._lock:
+            entry = self._reports.get(key)
+        if entry is None:
+            self.refresh([category])
+            with self._lock:
+                entry = self._reports.get(key)
+        if entry is None:
+            raise Exception('Drifts of %s could not be loaded' % category)
+        return entry
@@ -1,7 +1,7 @@
-from collections import OrderedDict
-
-import requests
+import time
+from collections import OrderedDict, defaultdict
 
+from . import http_client
 from .tracking import get_tracking_internal
 
 titles = {
@@ -16,10 +16,14 @@ titles = {
 }
 
 
-def get_report(category, untracked_only=False):
-    data = requests.get(
-        'https://people.wikimedia.org/~ladsgroup/drifts_{}.json'.format(category)).json()
-    tracked = get_tracking_internal()
+def get_drifts_url(category):
+    return 'https://people.wikimedia.org/~ladsgroup/drifts_{}.json'.format(
+        category)
+
+
+def build_report(data, tracked, untracked_only=False):
+    """Turns the content of a drifts file into the list of drifts shown in
+    the report, most widespread first"""
     metadata = data.get('_metadata', {})
     data = OrderedDict(sorted(
         [i for i in data.items() if i[0][0] != '_'],
@@ -31,8 +35,9 @@ def get_report(category, untracked_only=False):
             continue
         drift = data[drift_name]
         drift_parts = drift_name.replace('  ', ' ').split(' ')
+        title = titles.get(drift_parts[-1], drift_name)
         drift_report = {
-            'name': titles.get(drift_parts[-1], drift_name).format(drift_parts[0], drift_parts[1]),
+            'name': title.format(drift_parts[0], drift_parts[1]),
             'section_count': len(drift),
             'sections': ', '.join(drift.keys()),
             'tracked': tracked.get(drift_name, False),
@@ -53,3 +58,100 @@ def get_report(category, untracked_only=False):
         'report': report,
         'metadata': metadata
     }
+
+
+class ReportIndex(object):
+    """Summaries of the drifts of a report, without their host tables, and
+    the lookups needed to filter them by table, drift type, section and
+    tracked status. Host tables are kept apart and fetched one at a time."""
+
+    filters = ('table', 'type', 'section', 'tracked')
+    sorts = ('section_count', 'host_count', 'name')
+
+    def __init__(self, report):
+        self.summaries = []
+        self.host_tables = {}
+        self._lookups = {name: defaultdict(set) for name in self.filters}
+        # Reports are ordered by section_count already
+        for position, drift in enumerate(report):
+            drift_parts = drift['code'].replace('  ', ' ').split(' ')
+            sections = list(
+                OrderedDict.fromkeys(row[0] for row in drift['table']))
+            self.summaries.append({
+                'name': drift['name'],
+                'code': drift['code'],
+                'table': drift_parts[0],
+                'type': drift_parts[-1],
+                'section_count': drift['section_count'],
+                'sections': sections,
+                'host_count': len(drift['table']),
+                'tracked': drift['tracked'],
+            })
+            self.host_tables[drift['code']] = drift['table']
+            self._lookups['table'][drift_parts[0]].add(position)
+            self._lookups['type'][drift_parts[-1]].add(position)
+            for section in sections:
+                self._lookups['section'][section].add(position)
+            tracked = '1' if drift['tracked'] else '0'
+            self._lookups['tracked'][tracked].add(position)
+
+    def query(self, filters=None, sort='section_count', descending=True,
+              page=1, limit=50):
+        positions = None
+        for name, value in (filters or {}).items():
+            matching = self._lookups[name].get(value, set())
+            if positions is None:
+                positions = matching
+            else:
+                positions = positions & matching
+        if positions is None:
+            positions = range(len(self.summaries))
+        # Ties keep the order of the report
+        positions = sorted(positions)
+        positions.sort(
+            key=lambda i: self.summaries[i][sort], reverse=descending)
+        start = (page - 1) * limit
+        return {
+            'total': len(positions),
+            'page': page,
+            'limit': limit,
+            'drifts': [
+                self.summaries[i] for i in positions[start:start + limit]],
+        }
+
+
+def build_stats(report):
+    stats = {
+        'total': 0, 'widespread': 0, 'untracked': 0,
+        'untracked_widespread': 0}
+    for drift in report:
+        widespread = drift['section_count'] > 5
+        stats['total'] += 1
+        stats['widespread'] += widespread
+        stats['untracked'] += not drift['tracked']
+        stats['untracked_widespread'] += widespread and not drift['tracked']
+    return stats
+
+
+def describe_run(metadata):
+    """Start, end and duration of the run that produced the drifts file,
+    formatted for the report"""
+    start_time = metadata.get('time_start')
+    end_time = metadata.get('time_end')
+    duration = None
+    if start_time and end_time:
+        duration = int(end_time) - int(start_time)
+        duration = "{:04.2f}".format(duration/3600)
+    if end_time:
+        end_time = time.strftime(
+            '%d %b %Y %H:%M:%S', time.gmtime(end_time))
+    if start_time:
+        start_time = time.strftime(
+            '%d %b %Y %H:%M:%S', time.gmtime(start_time))
+    return {
+        'start_time': start_time, 'end_time': end_time, 'duration': duration}
+
+
+def get_report(category, untracked_only=False):
+    data = http_client.get(get_drifts_url(category)).json()
+    return build_report(data, get_tracking_internal(), untracked_only)
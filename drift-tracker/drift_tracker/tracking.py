@@ -1,12 +1,16 @@
 import json
 
-import requests
+from . import http_client
+
+
+TRACKING_URL = (
+    'https://wikitech.wikimedia.org/w/index.php'
+    '?title=User:Ladsgroup/drifts.json&action=raw')
 
 
 def get_tracking_internal():
     try:
-        text = requests.get(
-            'https://wikitech.wikimedia.org/w/index.php?title=User:Ladsgroup/drifts.json&action=raw').text
+        text = http_client.get(TRACKING_URL).text
         return json.loads(text)
 
     except BaseException:
@@ -0,0 +1,136 @@
+"""Compact, columnar format of the drift files.
+
+Next to drifts_{category}.json a run can write drifts_{category}.jsonl.gz,
+a gzipped JSON lines file:
+
+- The first line is a header with the metadata of the run, the dictionaries
+  of sections, hosts, wikis and drift types, and an index of all drifts:
+  [table and piece, drift type id, number of entries, {section id: number
+  of entries}]. Consumers only interested in counts can stop reading there.
+- Then one line per drift and section, in the order of the index:
+  [drift number, section id, [host ids], [wiki ids]].
+
+Host and wiki names are only stored once in the dictionaries no matter in
+how many drifts they show up.
+"""
+import gzip
+import json
+import os
+
+FORMAT = 'drifts-columnar'
+VERSION = 1
+
+
+def columnar_path(path):
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    return path + '.jsonl.gz'
+
+
+class _Dictionary(object):
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def id(self, value):
+        id_ = self._ids.get(value)
+        if id_ is None:
+            id_ = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return id_
+
+
+def _section_name(section):
+    # Same key json.dumps() gives it in the plain drift file
+    return 'null' if section is None else str(section)
+
+
+def write_columnar(path, metadata, drifts):
+    """Writes `drifts` ({drift: {section: entries}}, entries being
+    'host:wiki' strings) to path in the columnar format"""
+    sections = _Dictionary()
+    hosts = _Dictionary()
+    wikis = _Dictionary()
+    types = _Dictionary()
+    index = []
+    lines = []
+    for number, drift in enumerate(sorted(drifts)):
+        prefix, _, type_ = drift.rpartition(' ')
+        counts = {}
+        for section in sorted(drifts[drift], key=_section_name):
+            entries = sorted(drifts[drift][section])
+            section_id = sections.id(_section_name(section))
+            counts[section_id] = len(entries)
+            host_ids = []
+            wiki_ids = []
+            for entry in entries:
+                host, _, wiki = entry.rpartition(':')
+                host_ids.append(hosts.id(host))
+                wiki_ids.append(wikis.id(wiki))
+            lines.append([number, section_id, host_ids, wiki_ids])
+        index.append([prefix, types.id(type_), sum(counts.values()), counts])
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'metadata': metadata,
+        'sections': sections.values,
+        'hosts': hosts.values,
+        'wikis': wikis.values,
+        'types': types.values,
+        'index': index,
+    }
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(header, separators=(',', ':')) + '\n')
+        for line in lines:
+            f.write(json.dumps(line, separators=(',', ':')) + '\n')
+    os.replace(tmp_path, path)
+
+
+def _read_header(f):
+    header = json.loads(f.readline())
+    if header.get('format') != FORMAT or header.get('version') != VERSION:
+        raise Exception('Not a version %d columnar drift file' % VERSION)
+    return header
+
+
+def _drift_name(header, entry):
+    return '{} {}'.format(entry[0], header['types'][entry[1]])
+
+
+def read_index(path):
+    """Metadata and per section counts of every drift, without decoding
+    any host list"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = _read_header(f)
+    sections = header['sections']
+    return {
+        'metadata': header['metadata'],
+        'drifts': {
+            _drift_name(header, entry): {
+                sections[int(section)]: count
+                for section, count in entry[3].items()}
+            for entry in header['index']
+        },
+    }
+
+
+def read_columnar(path, drifts=None):
+    """Decodes the file back into the layout of the plain drift file, only
+    for the given drift names if any"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = _read_header(f)
+        names = [_drift_name(header, entry) for entry in header['index']]
+        sections = header['sections']
+        hosts = header['hosts']
+        wikis = header['wikis']
+        data = {'_metadata': header['metadata']}
+        for line in f:
+            number, section, host_ids, wiki_ids = json.loads(line)
+            name = names[number]
+            if drifts is not None and name not in drifts:
+                continue
+            data.setdefault(name, {})[sections[section]] = [
+                '{}:{}'.format(hosts[host], wikis[wiki])
+                for host, wiki in zip(host_ids, wiki_ids)]
+    return data
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60)
+# Phases measured inside of the query phase
+NESTED_PHASES = ('spawn', 'parse')
+
+
+class PhaseStats(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': round(self.total, 3),
+            'max': round(self.max, 3),
+        }
+
+
+class Timings(object):
+    """Time spent per phase of a run (fetch, spawn, query, parse, compare,
+    write), broken down by section and host.
+
+    The section and host of a measurement come from the labels() context
+    of the thread taking it, so code deep down like the sql backends
+    doesn't need to know about them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._phases = defaultdict(PhaseStats)
+        self._sections = defaultdict(lambda: defaultdict(PhaseStats))
+        self._hosts = defaultdict(lambda: defaultdict(PhaseStats))
+
+    @contextmanager
+    def labels(self, section, host):
+        previous = getattr(self._local, 'labels', (None, None))
+        self._local.labels = (section, host)
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    @contextmanager
+    def measure(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def add(self, phase, seconds):
+        section, host = getattr(self._local, 'labels', (None, None))
+        with self._lock:
+            self._phases[phase].add(seconds)
+            if host is not None:
+                self._sections[section][phase].add(seconds)
+                self._hosts[(section, host)][phase].add(seconds)
+
+    def summary(self, slowest=20):
+        def host_total(phases):
+            return sum(
+                stats.total for phase, stats in phases.items()
+                if phase not in NESTED_PHASES)
+        with self._lock:
+            hosts = sorted(
+                self._hosts.items(),
+                key=lambda i: host_total(i[1]),
+                reverse=True)[:slowest]
+            return {
+                'phases': {
+                    phase: stats.to_dict()
+                    for phase, stats in self._phases.items()},
+                'sections': {
+                    str(section): {
+                        phase: stats.to_dict()
+                        for phase, stats in phases.items()}
+                    for section, phases in self._sections.items()},
+                'slowest_hosts': [
+                    {
+                        'section': section,
+                        'host': host,
+                        'total': round(host_total(phases), 3),
+                    }
+                    for (section, host), phases in hosts],
+            }
+
+    def write_prometheus(self, path, prefix='db_drift_checker'):
+        """Writes the timings in the Prometheus textfile exporter format"""
+        lines = [
+            '# HELP {}_phase_seconds Time spent per phase and section'.format(prefix),
+            '# TYPE {}_phase_seconds histogram'.format(prefix),
+        ]
+        with self._lock:
+            for section, phases in sorted(self._sections.items(), key=str):
+                for phase, stats in sorted(phases.items()):
+                    labels = 'phase="{}",section="{}"'.format(phase, section)
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, stats.buckets):
+                        cumulative += count
+                        lines.append('{}_phase_seconds_bucket{{{},le="{}"}} {}'.format(
+                            prefix, labels, bound, cumulative))
+                    lines.append('{}_phase_seconds_bucket{{{},le="+Inf"}} {}'.format(
+                        prefix, labels, stats.count))
+                    lines.append('{}_phase_seconds_sum{{{}}} {}'.format(
+                        prefix, labels, stats.total))
+                    lines.append('{}_phase_seconds_count{{{}}} {}'.format(
+                        prefix, labels, stats.count))
+            lines += [
+                '# HELP {}_host_seconds_total Time spent per phase and host'.format(prefix),
+                '# TYPE {}_host_seconds_total counter'.format(prefix),
+            ]
+            for (section, host), phases in sorted(self._hosts.items(), key=str):
+                for phase, stats in sorted(phases.items()):
+                    lines.append(
+                        '{}_host_seconds_total{{phase="{}",section="{}",host="{}"}} {}'.format(
+                            prefix, phase, section, host, stats.total))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+timings = Timings()
@@ -0,0 +1,142 @@
+"""Sampling of the fleet, for quick drift scans.
+
+Every section gets `count` wikis (or `fraction` of them, at least one),
+spread over its hosts so that every host is checked at least once. With
+the drift files of a previous run, wikis that had more drifts are more
+likely to be picked.
+
+The report tells apart drifts that were found on every checked (host, wiki)
+of the sample, likely fleet-wide, from the ones only found on some of them,
+whose extent needs a full scan. Using the rule of three, a drift found on
+all n checked jobs is on at least 1 - 3/n of the fleet, and one found on
+none on at most 3/n, with 95% confidence (less so with weights, which
+favor the wikis that had drifts). Drifts found everywhere are only called
+confirmed when that lower bound reaches `min_share`, a small sample can't
+tell a fleet-wide drift from a common one.
+"""
+import math
+import random
+import threading
+from collections import defaultdict
+
+
+def drift_density(data):
+    """Number of drift entries per wiki in the content of a drifts file"""
+    density = defaultdict(int)
+    for name, sections in data.items():
+        if name.startswith('_'):
+            continue
+        for entries in sections.values():
+            for entry in entries:
+                density[entry.rpartition(':')[2]] += 1
+    return density
+
+
+class FleetSample(object):
+    def __init__(self, fraction=None, count=None, density=None, seed=None, min_share=0.9):
+        if (fraction is None) == (count is None):
+            raise Exception('A sample needs either a fraction or a count')
+        self.fraction = fraction
+        self.count = count
+        self.density = density
+        self.seed = seed
+        self.min_share = min_share
+        self._random = random.Random(seed)
+        # section -> sizes and (host, wiki) of the sample
+        self.sections = {}
+        self._lock = threading.Lock()
+
+    def size(self, total):
+        if self.count is not None:
+            return min(self.count, total)
+        return min(max(1, math.ceil(self.fraction * total)), total)
+
+    def _weighted_order(self, wikis):
+        if not self.density:
+            wikis = list(wikis)
+            self._random.shuffle(wikis)
+            return wikis
+        # Efraimidis-Spirakis: sorting by u ** (1 / weight) is a weighted
+        # sample without replacement
+        return sorted(
+            wikis,
+            key=lambda wiki: self._random.random() ** (1 / (1 + self.density.get(wiki, 0))),
+            reverse=True)
+
+    def select(self, section, hosts, wikis):
+        """(host, wiki) jobs of the sample of a section"""
+        if not hosts or not wikis:
+            return []
+        wikis = self._weighted_order(sorted(wikis))
+        hosts = list(hosts)
+        # So that the same host doesn't always get the heaviest wiki
+        offset = self._random.randrange(len(hosts))
+        hosts = hosts[offset:] + hosts[:offset]
+        size = self.size(len(wikis))
+        jobs = [
+            (hosts[i % len(hosts)], wikis[i % size])
+            for i in range(max(size, len(hosts)))]
+        with self._lock:
+            self.sections[section] = {
+                'hosts': len(hosts),
+                'wikis': len(wikis),
+                'sampled_wikis': size,
+                'jobs': jobs,
+            }
+        return jobs
+
+    def report(self, run, failures=(), previous=None):
+        """Drifts of the run's store sorted by what the sample tells about
+        them. `failures` are the jobs that could not be checked and
+        `previous` the content of the drifts file of the last full run."""
+        failed = {(i['host'], i['wiki']) for i in failures}
+        failed_hosts = {i['host'] for i in failures if i['wiki'] is None}
+        checked = {}
+        for section, sample in self.sections.items():
+            checked[section] = {
+                '%s:%s' % (host, wiki) for host, wiki in sample['jobs']
+                if run.applies_to(wiki) and (host, wiki) not in failed
+                and host not in failed_hosts}
+        total = sum(len(i) for i in checked.values())
+        min_share = round(max(0, 1 - 3 / total), 3) if total else None
+
+        confirmed = {}
+        needs_full_scan = {}
+        found = run.store.to_dict()
+        for drift, sections in found.items():
+            if drift.startswith('_'):
+                continue
+            seen = sum(
+                len(set(entries) & checked.get(section, set()))
+                for section, entries in sections.items())
+            if total and seen == total and min_share >= self.min_share:
+                confirmed[drift] = {'seen': seen, 'min_share': min_share}
+            else:
+                needs_full_scan[drift] = {
+                    'seen': seen, 'share': round(seen / total, 3) if total else None,
+                    'min_share': min_share if total and seen == total else None,
+                    'sections': sorted(sections)}
+        not_seen = {}
+        for drift in (previous or {}):
+            if drift.startswith('_') or drift in found:
+                continue
+            not_seen[drift] = {'max_share': round(min(1, 3 / total), 3) if total else None}
+        return {
+            'fraction': self.fraction,
+            'count': self.count,
+            'seed': self.seed,
+            'weighted': bool(self.density),
+            'min_share': self.min_share,
+            'checked': total,
+            'sections': {
+                section: {
+                    'hosts': sample['hosts'],
+                    'wikis': sample['wikis'],
+                    'sampled_wikis': sample['sampled_wikis'],
+                    'checked': len(checked[section]),
+                }
+                for section, sample in sorted(self.sections.items())},
+            'confirmed': confirmed,
+            'needs_full_scan': needs_full_scan,
+            'not_seen': not_seen,
+        }
@@ -0,0 +1,204 @@
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LatencyTracker(object):
+    """Keeps an exponentially weighted moving average of how long queries
+    take on every host, to give each host a timeout that fits it instead
+    of one value for the whole fleet."""
+
+    def __init__(self, alpha=0.3, factor=4, min_timeout=2, max_timeout=60):
+        self.alpha = alpha
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._averages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            average = self._averages.get(key)
+            if average is None:
+                self._averages[key] = seconds
+            else:
+                self._averages[key] = \
+                    self.alpha * seconds + (1 - self.alpha) * average
+
+    def timed_out(self, key, timeout):
+        """Doubles the next timeout of a key whose query just ran out of
+        `timeout`, so that a retry has a chance on a host that got slower"""
+        with self._lock:
+            self._averages[key] = max(
+                self._averages.get(key, 0), 2 * timeout / self.factor)
+
+    def measure(self, key, default, func):
+        """Calls func with the timeout of key, and learns from how long it
+        took or from it running out of time"""
+        timeout = self.timeout(key, default)
+        start = time.time()
+        try:
+            result = func(timeout)
+        except Exception:
+            if time.time() - start >= timeout:
+                self.timed_out(key, timeout)
+            raise
+        self.observe(key, time.time() - start)
+        return result
+
+    def timeout(self, key, default):
+        """Timeout for the next query, `default` until the host is known"""
+        with self._lock:
+            average = self._averages.get(key)
+        if average is None:
+            return default
+        return max(self.min_timeout, min(self.max_timeout, average * self.factor))
+
+
+def spread_host_jobs(jobs, window=1):
+    """Orders (section, host, wikis) jobs so that the ones close to each
+    other, which end up running at the same time, are on different sections
+    and machines (db1234:3311 and db1234:3312 being the same machine).
+    Sections are taken round-robin, the ones with the most wikis first, and
+    a job is only put within `window` of another one on the same machine if
+    there is nothing else left to pick."""
+    queues = {}
+    for job in sorted(jobs, key=lambda job: -len(job[2])):
+        queues.setdefault(job[0], deque()).append(job)
+    sections = sorted(
+        queues, key=lambda section: -sum(len(job[2]) for job in queues[section]))
+    recent = deque(maxlen=max(1, window))
+    ordered = []
+    turn = 0
+    while len(ordered) < len(jobs):
+        candidates = [
+            sections[(turn + i) % len(sections)] for i in range(len(sections))]
+        candidates = [section for section in candidates if queues[section]]
+        picked = None
+        for section in candidates:
+            for job in queues[section]:
+                if job[1].split(':')[0] not in recent:
+                    picked = job
+                    break
+            if picked is not None:
+                break
+        if picked is None:
+            picked = queues[candidates[0]][0]
+        queues[picked[0]].remove(picked)
+        ordered.append(picked)
+        recent.append(picked[1].split(':')[0])
+        turn = sections.index(picked[0]) + 1
+    return ordered
+
+
+class ScanScheduler(object):
+    """Runs (section, host) jobs on a thread pool while making sure no
+    section or host gets more than its share of concurrent queries.
+
+    Jobs raising one of the `retry_on` exceptions are put back at the end
+    of the queue and retried after an exponential backoff, so a struggling
+    host doesn't hold up the others. Jobs that keep failing end up in
+    `failures`.
+    With jobs=1 every job runs inline, exactly like the serial scan.
+    """
+
+    def __init__(self, jobs=1, section_jobs=0, host_jobs=1, retries=2,
+                 backoff=2, retry_on=()):
+        self.jobs = max(1, jobs)
+        self.section_jobs = section_jobs
+        self.host_jobs = host_jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = tuple(retry_on)
+        self.latency = LatencyTracker()
+        self.failures = []
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        self._futures = []
+        self._deferred = []
+        self._executor = None
+        if self.jobs > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def _semaphore(self, key, limit):
+        if not limit:
+            return None
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(limit)
+            return self._semaphores[key]
+
+    def _fail(self, job, error):
+        section, host, wiki, _, _, attempt = job
+        with self._lock:
+            self.failures.append({
+                'section': section,
+                'host': host,
+                'wiki': wiki,
+                'attempts': attempt + 1,
+                'error': str(error),
+            })
+
+    def _run(self, job):
+        section, host, wiki, func, args, attempt = job
+        # Always acquire in the same order (section, then host) so that
+        # two workers can never wait on each other.
+        semaphores = [
+            self._semaphore(('section', section), self.section_jobs),
+            self._semaphore(('host', host), self.host_jobs),
+        ]
+        semaphores = [i for i in semaphores if i is not None]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            return func(*args)
+        except self.retry_on as e:
+            if attempt >= self.retries:
+                print('Giving up on', host, wiki or '', e)
+                self._fail(job, e)
+                return
+            print('Retrying', host, wiki or '', 'later:', e)
+            with self._lock:
+                self._deferred.append((
+                    time.time() + self.backoff * 2 ** attempt,
+                    (section, host, wiki, func, args, attempt + 1)))
+        except Exception as e:
+            if self._executor is None:
+                raise
+            # One broken host should not take the whole run down with it
+            traceback.print_exc()
+            self._fail(job, e)
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    def _start(self, job):
+        if self._executor is None:
+            return self._run(job)
+        self._futures.append(self._executor.submit(self._run, job))
+
+    def submit(self, section, host, func, *args, wiki=None):
+        return self._start((section, host, wiki, func, args, 0))
+
+    def wait(self):
+        while True:
+            futures, self._futures = self._futures, []
+            for future in futures:
+                future.result()
+            with self._lock:
+                deferred, self._deferred = self._deferred, []
+            if not deferred and not self._futures:
+                return
+            deferred.sort(key=lambda i: i[0])
+            for not_before, job in deferred:
+                delay = not_before - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self._start(job)
+
+    def shutdown(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
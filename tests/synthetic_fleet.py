@@ -0,0 +1,124 @@
+"""Synthetic fleet for the tests running db_drift_checker.py end to end.
+
+It is generated like the benchmark's, in a scratch directory, and queried
+through benchmarks/fake_sql.py, which logs every query it gets.
+"""
+import argparse
+import base64
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import synthetic  # noqa: E402
+from bench_drift_checker import setup_fleet  # noqa: E402
+from data_access.cache import HttpCache  # noqa: E402
+from data_access.wmf import Gerrit  # noqa: E402
+
+
+class SyntheticFleet(object):
+    def __init__(self, sections=2, hosts=2, wikis=6, tables=8,
+                 drift_rate=0.05, seed=0):
+        self.tables = tables
+        self.seed = seed
+        self.workdir = tempfile.mkdtemp(prefix='drift_test_')
+        self.dumps = setup_fleet(self.workdir, argparse.Namespace(
+            sections=sections, hosts=hosts, wikis=wikis, tables=tables,
+            drift_rate=drift_rate, seed=seed))
+        self.log = os.path.join(self.workdir, 'queries.jsonl')
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def checker(self, *args, check=True):
+        """Runs db_drift_checker.py in the fleet's directory"""
+        return subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'db_drift_checker.py')] +
+            list(args),
+            cwd=self.workdir, check=check, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, universal_newlines=True,
+            env=dict(os.environ, FAKE_SQL_LOG=self.log))
+
+    def run(self, *args):
+        """Checks the core tables of the whole fleet, returns the queries
+        fake_sql.py got"""
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        command = '{} {} {} {{wiki}} -- '.format(
+            shlex.quote(sys.executable),
+            shlex.quote(os.path.join(ROOT, 'benchmarks', 'fake_sql.py')),
+            shlex.quote(self.dumps))
+        self.checker(
+            'core', command, '--prod', '--all', '--offline',
+            '--cache-dir', self.path('cache'), '--flush-interval', '0',
+            *args)
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    @staticmethod
+    def checked(queries):
+        """(host, wiki) whose tables were queried"""
+        return sorted(
+            (query['host'], wiki) for query in queries
+            if not query['versions'] for wiki in query['wikis'])
+
+    def jobs(self):
+        """(host, wiki) of every wiki on every host"""
+        return sorted(
+            (host, name[:-len('.json')])
+            for host in os.listdir(self.dumps)
+            for name in os.listdir(os.path.join(self.dumps, host))
+            if name.endswith('.json'))
+
+    def drifts(self, name='drifts_core.json'):
+        """Drifts of a drift file, without the metadata and the order of
+        the entries"""
+        with open(self.path(name), 'r') as f:
+            data = json.loads(f.read())
+        return {
+            drift: {section: sorted(entries)
+                    for section, entries in sections.items()}
+            for drift, sections in data.items() if drift != '_metadata'}
+
+    def metadata(self, name='drifts_core.json'):
+        with open(self.path(name), 'r') as f:
+            return json.loads(f.read())['_metadata']
+
+    def rows(self, host, wiki):
+        with open(os.path.join(self.dumps, host, wiki + '.json'), 'r') as f:
+            return json.loads(f.read())
+
+    def write_rows(self, host, wiki, rows):
+        """Changes what the wiki looks like on the host, keeping the time
+        the dump was modified"""
+        path = os.path.join(self.dumps, host, wiki)
+        stat = os.stat(path + '.txt')
+        with open(path + '.json', 'w') as f:
+            f.write(json.dumps(rows))
+        with open(path + '.txt', 'w') as f:
+            f.write(synthetic.to_vertical(rows))
+        os.utime(path + '.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def schema(self):
+        return synthetic.generate_schema(self.tables, self.seed)
+
+    def set_schema(self, schema):
+        """Changes the expected schema of the core tables"""
+        cache = HttpCache(self.path('cache'))
+        with open(os.path.join(ROOT, 'abstract_paths.json'), 'r') as f:
+            paths = json.loads(f.read())['core']['path']
+        for path in paths:
+            cache.put(
+                Gerrit().get_url(path),
+                base64.b64encode(json.dumps(schema).encode('utf-8')))
@@ -0,0 +1,158 @@
+import http.server
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from data_access import cache
+from data_access.cache import HttpCache, OfflineCacheMiss
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves `files` ({path: (body, etag, last_modified)}), answering
+    conditional requests with a 304 when the validators still match"""
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.files:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body, etag, last_modified = self.files[self.path]
+        not_modified = (
+            (etag and self.headers.get('If-None-Match') == etag) or
+            (last_modified and
+             self.headers.get('If-Modified-Since') == last_modified))
+        self.send_response(304 if not_modified else 200)
+        if etag:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        if not_modified:
+            self.end_headers()
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CacheTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), Handler)
+        cls.base_url = 'http://127.0.0.1:{}'.format(cls.server.server_port)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Handler.files = {}
+        Handler.requests = []
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def serve(self, path, body, etag=None, last_modified=None):
+        Handler.files[path] = (body, etag, last_modified)
+        return self.base_url + path
+
+
+class HttpCacheTest(CacheTestCase):
+    def test_fresh_entries_are_not_requested_again(self):
+        url = self.serve('/a', b'one', etag='"1"')
+        http_cache = HttpCache(self.directory, ttl=3600)
+        self.assertEqual(http_cache.get(url), b'one')
+        self.assertEqual(http_cache.get(url), b'one')
+        self.assertEqual(len(Handler.requests), 1)
+
+    def test_etag_revalidation(self):
+        url = self.serve('/a', b'one', etag='"1"')
+        http_cache = HttpCache(self.directory, ttl=0)
+        self.assertEqual(http_cache.get(url), b'one')
+        self.assertEqual(http_cache.get(url), b'one')
+        self.assertEqual(Handler.requests[1][1].get('If-None-Match'), '"1"')
+
+        self.serve('/a', b'two', etag='"2"')
+        self.assertEqual(http_cache.get(url), b'two')
+        self.assertEqual(http_cache.get(url), b'two')
+        self.assertEqual(Handler.requests[3][1].get('If-None-Match'), '"2"')
+
+    def test_last_modified_revalidation(self):
+        last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        url = self.serve('/a', b'one', last_modified=last_modified)
+        http_cache = HttpCache(self.directory, ttl=0)
+        self.assertEqual(http_cache.get(url), b'one')
+        # Changed on the server, but the cache can't tell
+        Handler.files['/a'] = (b'two', None, last_modified)
+        self.assertEqual(http_cache.get(url), b'one')
+        headers = Handler.requests[1][1]
+        self.assertEqual(headers.get('If-Modified-Since'), last_modified)
+        self.assertNotIn('If-None-Match', headers)
+
+    def test_ttl_expiry(self):
+        url = self.serve('/a', b'one', etag='"1"')
+        http_cache = HttpCache(self.directory, ttl=60)
+        now = time.time()
+        with mock.patch('data_access.cache.time.time', return_value=now):
+            http_cache.get(url)
+        with mock.patch('data_access.cache.time.time', return_value=now + 59):
+            http_cache.get(url)
+        self.assertEqual(len(Handler.requests), 1)
+        with mock.patch('data_access.cache.time.time', return_value=now + 61):
+            self.assertEqual(http_cache.get(url), b'one')
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertEqual(Handler.requests[1][1].get('If-None-Match'), '"1"')
+        # The 304 starts a new ttl
+        with mock.patch('data_access.cache.time.time', return_value=now + 100):
+            http_cache.get(url)
+        self.assertEqual(len(Handler.requests), 2)
+
+    def test_offline(self):
+        url = self.serve('/a', b'one')
+        HttpCache(self.directory).get(url)
+        offline = HttpCache(self.directory, ttl=0, offline=True)
+        self.assertEqual(offline.get(url), b'one')
+        with self.assertRaises(OfflineCacheMiss):
+            offline.get(self.serve('/b', b'two'))
+        self.assertEqual(len(Handler.requests), 1)
+
+
+class NoHttpCacheTest(CacheTestCase):
+    """configure_cache() as db_drift_checker.py calls it with
+    --no-http-cache"""
+
+    def setUp(self):
+        super().setUp()
+        cache.configure_cache(self.directory, enabled=False)
+        self.addCleanup(cache.configure_cache, enabled=False)
+        self.addCleanup(cache._prefetched.clear)
+
+    def test_fetch_downloads_every_time(self):
+        url = self.serve('/a', b'one', etag='"1"')
+        self.assertEqual(cache.fetch(url), b'one')
+        self.assertEqual(cache.fetch(url), b'one')
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertNotIn('If-None-Match', Handler.requests[1][1])
+
+    def test_prefetched_files_are_handed_over(self):
+        urls = [self.serve('/a', b'one'), self.serve('/b', b'two')]
+        cache.prefetch(urls + [self.base_url + '/missing'])
+        self.assertEqual(len(Handler.requests), 3)
+        self.assertEqual([cache.fetch(url) for url in urls], [b'one', b'two'])
+        self.assertEqual(len(Handler.requests), 3)
+        with self.assertRaises(Exception):
+            cache.fetch(self.base_url + '/missing')
+
+
+if __name__ == '__main__':
+    unittest.main()
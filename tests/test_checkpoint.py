@@ -0,0 +1,88 @@
+import json
+import os
+import time
+import unittest
+
+from synthetic_fleet import SyntheticFleet
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = SyntheticFleet()
+        self.addCleanup(self.fleet.cleanup)
+
+    def test_resume_skips_finished_jobs(self):
+        self.fleet.run('--checkpoint', 'journal.jsonl')
+        full = self.fleet.drifts()
+        with open(self.fleet.path('journal.jsonl.previous'), 'r') as f:
+            lines = f.readlines()
+        # Killed while writing the record of the sixth job
+        header, done, cut = lines[0], lines[1:6], lines[6]
+        with open(self.fleet.path('journal.jsonl'), 'w') as f:
+            f.write(header + ''.join(done) + cut[:20])
+        os.remove(self.fleet.path('drifts_core.json'))
+
+        queries = self.fleet.run('--resume', '--checkpoint', 'journal.jsonl')
+        done = {(i['host'], i['wiki']) for i in map(json.loads, done)}
+        self.assertEqual(len(done), 5)
+        self.assertEqual(
+            self.fleet.checked(queries),
+            [job for job in self.fleet.jobs() if job not in done])
+        self.assertEqual(self.fleet.drifts(), full)
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = SyntheticFleet()
+        self.addCleanup(self.fleet.cleanup)
+        self.assertEqual(
+            self.fleet.checked(self.fleet.run('--incremental')),
+            self.fleet.jobs())
+        self.host, self.wiki = self.fleet.jobs()[3]
+
+    def assertSameAsFullRun(self):
+        incremental = self.fleet.drifts()
+        self.fleet.run()
+        self.assertEqual(incremental, self.fleet.drifts())
+
+    def test_unchanged_wikis_are_not_queried(self):
+        drifts = self.fleet.drifts()
+        queries = self.fleet.run('--incremental')
+        self.assertEqual(self.fleet.checked(queries), [])
+        self.assertTrue(all(query['versions'] for query in queries))
+        self.assertEqual(self.fleet.drifts(), drifts)
+
+    def test_create_time_change(self):
+        path = os.path.join(self.fleet.dumps, self.host, self.wiki + '.txt')
+        os.utime(path, (time.time() + 60, time.time() + 60))
+        self.assertEqual(
+            self.fleet.checked(self.fleet.run('--incremental')),
+            [(self.host, self.wiki)])
+        self.assertSameAsFullRun()
+
+    def test_table_count_change(self):
+        rows = self.fleet.rows(self.host, self.wiki)
+        dropped = rows[0]['TABLE_NAME']
+        self.fleet.write_rows(self.host, self.wiki, [
+            row for row in rows if row['TABLE_NAME'] != dropped])
+        self.assertEqual(
+            self.fleet.checked(self.fleet.run('--incremental')),
+            [(self.host, self.wiki)])
+        self.assertSameAsFullRun()
+
+    def test_expected_schema_change(self):
+        schema = self.fleet.schema()
+        column = schema[0]['columns'][0]
+        column['type'] = 'mwtinyint' if column['type'] != 'mwtinyint' else 'integer'
+        self.fleet.set_schema(schema)
+        self.assertEqual(
+            self.fleet.checked(self.fleet.run('--incremental')),
+            self.fleet.jobs())
+        self.assertSameAsFullRun()
+        # The new expected schema is what the journal has now
+        self.assertEqual(
+            self.fleet.checked(self.fleet.run('--incremental')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
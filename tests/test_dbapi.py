@@ -0,0 +1,89 @@
+import json
+import os
+import unittest
+
+from synthetic_fleet import SyntheticFleet
+
+# On the path once synthetic_fleet is imported
+import fake_dbapi  # noqa: E402
+from data_access.sql import (DbApiBackend, QueryError,  # noqa: E402
+                             iter_vertical_rows)
+
+
+class DbApiBackendTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fleet = SyntheticFleet(sections=1, hosts=2, wikis=3)
+        cls.directory = fake_dbapi.build(
+            cls.fleet.dumps, cls.fleet.path('sqlite'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fleet.cleanup()
+
+    def setUp(self):
+        self.connector = fake_dbapi.Connector(self.directory)
+        self.backend = DbApiBackend('eqiad', self.connector)
+        self.addCleanup(self.backend.close)
+        self.host, _ = self.fleet.jobs()[0]
+        self.wikis = [wiki for host, wiki in self.fleet.jobs()
+                      if host == self.host]
+
+    def cli_rows(self, wiki):
+        """Rows as the mysql client prints them"""
+        path = os.path.join(self.fleet.dumps, self.host, wiki + '.txt')
+        with open(path, 'r') as f:
+            return list(iter_vertical_rows(f.readlines()))
+
+    def assertSameRows(self, rows, expected):
+        self.assertEqual(
+            sorted(map(json.dumps, rows)), sorted(map(json.dumps, expected)))
+
+    def test_rows_match_the_mysql_client(self):
+        self.assertSameRows(
+            self.backend.get_tables_structure(self.host, '', self.wikis),
+            sum((self.cli_rows(wiki) for wiki in self.wikis), []))
+        self.assertSameRows(
+            self.backend.get_table_structure(self.host, '', self.wikis[0]),
+            self.cli_rows(self.wikis[0]))
+        each = self.backend.get_each_table_structure(
+            self.host, '', self.wikis)
+        self.assertEqual(sorted(each), self.wikis)
+        for wiki in self.wikis:
+            self.assertSameRows(each[wiki], self.cli_rows(wiki))
+
+    def test_schema_versions(self):
+        versions = self.backend.get_schema_versions(
+            self.host, '', self.wikis + ['nosuchwiki'])
+        self.assertEqual(sorted(versions), self.wikis)
+
+    def test_pooled_connections_get_the_timeout_of_every_query(self):
+        self.backend.get_table_structure(self.host, '', self.wikis[0], 5)
+        self.backend.get_tables_structure(self.host, '', self.wikis, 60)
+        self.backend.get_schema_versions(self.host, '', self.wikis, 7)
+        self.assertEqual(len(self.connector.connections), 1)
+        # Columns and statistics, then columns and statistics, then tables
+        self.assertEqual(
+            self.connector.connections[0].timeouts, [5, 5, 60, 60, 7])
+
+    def test_connections_are_per_host(self):
+        hosts = sorted({host for host, _ in self.fleet.jobs()})
+        for host in hosts + hosts:
+            self.backend.get_schema_versions(host, '', self.wikis)
+        self.assertEqual(len(self.connector.connections), len(hosts))
+
+    def test_failures(self):
+        with self.assertRaises(QueryError):
+            self.backend.get_schema_versions('db9999', '', self.wikis)
+        self.backend.get_schema_versions(self.host, '', self.wikis)
+        # A connection whose query failed is not used again
+        self.connector.connections[0]._db.execute(
+            'DETACH DATABASE information_schema')
+        with self.assertRaises(QueryError):
+            self.backend.get_schema_versions(self.host, '', self.wikis)
+        self.backend.get_schema_versions(self.host, '', self.wikis)
+        self.assertEqual(len(self.connector.connections), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
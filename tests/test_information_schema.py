@@ -0,0 +1,89 @@
+import unittest
+
+from domain.information_schema import (abstract_column, column_from_row,
+                                       diff_columns)
+from domain.table import Column
+
+# COLUMN_TYPE of every MySQL type the abstract schema converter handles,
+# but text ones, which production has as blobs
+COLUMN_TYPES = [
+    'int(10) unsigned',
+    'int(11)',
+    'tinyint(1)',
+    'tinyint(3) unsigned',
+    'smallint(5) unsigned',
+    'mediumint(8) unsigned',
+    'bigint(20) unsigned',
+    'binary(32)',
+    'varbinary(255)',
+    'tinyblob',
+    'blob',
+    'mediumblob',
+    'longblob',
+    "enum('one','two','three')",
+    'timestamp',
+    'datetime',
+    'date',
+    'decimal(10,2)',
+    'float',
+    'double',
+    'double unsigned',
+    'varchar(255)',
+    'char(2)',
+]
+
+
+def row(column_type, name='col', nullable='NO', extra=''):
+    return {
+        'COLUMN_NAME': name,
+        'COLUMN_TYPE': column_type,
+        'IS_NULLABLE': nullable,
+        'EXTRA': extra,
+    }
+
+
+class AbstractSchemaRoundTripTest(unittest.TestCase):
+    def assertRoundTrips(self, row_):
+        expected = Column.newFromAbstractSchema(abstract_column(row_))
+        actual = column_from_row(
+            row_['COLUMN_TYPE'], row_['IS_NULLABLE'], row_['EXTRA'])
+        self.assertEqual(diff_columns(expected, actual), [])
+        self.assertEqual(expected.type_, actual.type_)
+
+    def test_column_types(self):
+        for column_type in COLUMN_TYPES:
+            for nullable in ('NO', 'YES'):
+                with self.subTest(column_type=column_type, nullable=nullable):
+                    self.assertRoundTrips(row(column_type, nullable=nullable))
+
+    def test_auto_increment(self):
+        self.assertRoundTrips(
+            row('int(10) unsigned', extra='auto_increment'))
+
+    def test_mw_timestamps(self):
+        for column_type in ('binary(14)', 'varbinary(14)'):
+            with self.subTest(column_type=column_type):
+                row_ = row(column_type, name='rev_timestamp')
+                self.assertEqual(abstract_column(row_)['type'], 'mwtimestamp')
+                self.assertRoundTrips(row_)
+
+    def test_text_keeps_its_length(self):
+        self.assertEqual(abstract_column(row('mediumtext')), {
+            'name': 'col', 'type': 'text',
+            'options': {'length': 16777215, 'notnull': True}})
+
+    def test_text_is_checked_as_blob(self):
+        # With the binary charset, text columns are blobs in production
+        for text, blob in (('tinytext', 'tinyblob'), ('text', 'blob'),
+                           ('mediumtext', 'mediumblob'),
+                           ('longtext', 'longblob')):
+            with self.subTest(column_type=text):
+                expected = Column.newFromAbstractSchema(
+                    abstract_column(row(text)))
+                self.assertEqual(expected.type_, blob)
+                self.assertEqual(diff_columns(
+                    expected, column_from_row(blob, 'NO', '')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import unittest
+
+from synthetic_fleet import SyntheticFleet
+
+from checker import DriftStore  # noqa: E402
+
+
+class ShardTest(unittest.TestCase):
+    shards = 3
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fleet = SyntheticFleet()
+        cls.fleet.run()
+        cls.full = cls.fleet.drifts()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fleet.cleanup()
+
+    def partial(self, number):
+        return 'drifts_core.shard{}of{}.json'.format(number, self.shards)
+
+    def run_shards(self, *args):
+        checked = []
+        for number in range(1, self.shards + 1):
+            checked.append(self.fleet.checked(self.fleet.run(
+                '--shard', '{}/{}'.format(number, self.shards), *args)))
+        return checked
+
+    def merge(self, *partials):
+        path = self.fleet.path('drifts_core.json')
+        if os.path.exists(path):
+            os.remove(path)
+        return self.fleet.checker('merge', *partials, check=False)
+
+    def test_merge_equals_full_run(self):
+        self.assertTrue(self.full)
+        for shard_by in ('job', 'section'):
+            with self.subTest(shard_by=shard_by):
+                checked = self.run_shards('--shard-by', shard_by)
+                # Every job is done by exactly one of the shards
+                self.assertEqual(
+                    sorted(sum(checked, [])), self.fleet.jobs())
+                result = self.merge(*[
+                    self.partial(i) for i in range(1, self.shards + 1)])
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertEqual(self.fleet.drifts(), self.full)
+
+    def test_merged_stats(self):
+        self.fleet.run('--engine', 'batch')
+        full = self.fleet.metadata()['comparison_engine']
+        self.run_shards('--engine', 'batch')
+        result = self.merge(*[
+            self.partial(i) for i in range(1, self.shards + 1)])
+        self.assertEqual(result.returncode, 0, result.stderr)
+        merged = self.fleet.metadata()['comparison_engine']
+        for name in ('rows', 'tables', 'distinct_tables', 'distinct_columns',
+                     'distinct_indexes'):
+            self.assertEqual(merged[name], full[name], name)
+        self.assertGreater(full['distinct_tables'], 0)
+
+    def test_memory_peak_is_the_highest_one(self):
+        store = DriftStore('core', 0, path=os.devnull)
+        for peak in (5, 9, 7):
+            store.merge({'_metadata': {'memory_peak': peak}})
+        self.assertEqual(store.metadata['memory_peak'], 9)
+
+    def test_missing_shard(self):
+        self.run_shards()
+        result = self.merge(self.partial(1), self.partial(3))
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('Shards 2 of core are missing', result.stderr)
+        self.assertFalse(os.path.exists(self.fleet.path('drifts_core.json')))
+
+    def test_duplicate_shard(self):
+        self.run_shards()
+        result = self.merge(
+            self.partial(1), self.partial(2), self.partial(3),
+            self.partial(2))
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('Shards 2 of core are given more than once', result.stderr)
+        self.assertFalse(os.path.exists(self.fleet.path('drifts_core.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
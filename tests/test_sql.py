@@ -0,0 +1,51 @@
+import re
+import unittest
+
+from data_access.sql import iter_vertical_rows, parse_table_structure
+
+OUTPUT = '''*************************** 1. row ***************************
+  TABLE_SCHEMA: enwiki
+    TABLE_NAME: page
+   COLUMN_NAME: page_title
+   COLUMN_TYPE: varbinary(255)
+COLUMN_COMMENT: first line
+* second line
+*** third line
+  IS_GENERATED: NEVER
+*************************** 2. row ***************************
+  TABLE_SCHEMA: enwiki
+    TABLE_NAME: page
+   COLUMN_NAME: page_id
+   COLUMN_TYPE: int(10) unsigned
+COLUMN_COMMENT:
+  IS_GENERATED: NEVER
+'''
+
+
+def split_rows(res):
+    """How the rows used to be parsed, out of the whole output at once"""
+    rows = []
+    for row in res.split('\n******'):
+        def_ = re.findall(
+            r'^\s*([A-Z_]+?)\s*: *(.*?) *$',
+            '\n'.join(row.split('\n')[1:]), re.M)
+        if def_:
+            rows.append(dict(def_))
+    return rows
+
+
+class VerticalRowsTest(unittest.TestCase):
+    def test_multi_line_value_starting_with_a_star(self):
+        rows = list(iter_vertical_rows(OUTPUT.splitlines(True)))
+        self.assertEqual(rows, split_rows(OUTPUT))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['COLUMN_COMMENT'], 'first line')
+        self.assertEqual(rows[0]['IS_GENERATED'], 'NEVER')
+
+    def test_parse_table_structure(self):
+        self.assertEqual(
+            list(parse_table_structure(OUTPUT)), split_rows(OUTPUT))
+
+
+if __name__ == '__main__':
+    unittest.main()